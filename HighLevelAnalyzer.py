@@ -2,8 +2,1069 @@
 # For more information and documentation, please go to https://support.saleae.com/extensions/high-level-analyzer-extensions
 
 from saleae.analyzers import HighLevelAnalyzer, AnalyzerFrame, StringSetting, NumberSetting, ChoicesSetting
-# importing "array" for array creations
-import array as arr
+import atexit
+import csv
+import functools
+import json
+import struct
+import sys
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+
+
+#--------------------------------------------------------------------------
+# SDP data element stream parser
+#--------------------------------------------------------------------------
+class SDPStreamParser:
+    '''
+    Incremental parser for a stream of SDP data elements, as carried by the
+    attribute lists of SDP_ServiceAttributeResponse and
+    SDP_ServiceSearchAttributeResponse PDUs.
+
+    Bytes are added with feed(), which may be called once per continuation
+    packet.  They are kept in a ring buffer until the element they belong to is
+    complete, so an element split over packets is parsed once when its last
+    byte arrives instead of re-copying and re-parsing the carried data.
+
+    Elements are returned as (element type, value) nodes, where the value of a
+    sequence or alternative (types 6 and 7) is the list of its child nodes.
+
+    At most max_buffered bytes are held for attributes not handed out yet,
+    buffered or parsed.  When a (malformed) stream needs more, the parser sets
+    error, counts the bytes it drops in dropped and ignores the rest of the
+    stream until reset().
+    '''
+    # deepest sequence nesting accepted
+    s_max_depth = 32
+
+    # descriptor byte: (element type, data size) where a negative data size -n
+    # means the size follows the descriptor in the next n bytes
+    s_descriptors = {
+        0x00: (0, 0),                                           # Nil
+        0x08: (1, 1), 0x09: (1, 2), 0x0A: (1, 4), 0x0B: (1, 8), 0x0C: (1, 16),  # unsigned int
+        0x10: (2, 1), 0x11: (2, 2), 0x12: (2, 4), 0x13: (2, 8), 0x14: (2, 16),  # signed int
+        0x19: (3, 2), 0x1A: (3, 4), 0x1C: (3, 16),              # UUID
+        0x25: (4, -1), 0x26: (4, -2), 0x27: (4, -4),            # text string
+        0x28: (5, 1),                                           # boolean
+        0x35: (6, -1), 0x36: (6, -2), 0x37: (6, -4),            # data element sequence
+        0x3D: (7, -1), 0x3E: (7, -2), 0x3F: (7, -4),            # data element alternative
+        0x45: (8, -1), 0x46: (8, -2), 0x47: (8, -4)             # URL
+    }
+    s_descriptor_table = tuple(map(s_descriptors.get, range(256)))
+
+    s_element_type_names = {
+        0x0: "(Nil)",
+        0x1: "(UINT)",
+        0x2: "(INT)",
+        0x3: "(UUID)",
+        0x4: "(STR)",
+        0x5: "(BOOL)",
+        0x6: "(SEQ)",
+        0x7: "(ALT)",
+        0x8: "(URL)"
+    }
+
+    def __init__(self, attribute_depth=1, capacity=256, max_buffered=65536):
+        # attribute_depth is the nesting level of the sequence holding the
+        # (attribute id, value) pairs: 1 for an AttributeList, 2 for the
+        # AttributeLists of a ServiceSearchAttributeResponse.
+        self.attribute_depth = attribute_depth
+        self.max_buffered = max_buffered
+        self.dropped = 0
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.read_pos = 0
+        self.count = 0
+        self.error = None
+        self.reset()
+
+    def reset(self):
+        self.read_pos = 0
+        self.count = 0
+        self.offset = 0         # stream offset of the byte at read_pos
+        self.stack = []         # open sequences, [stream offset of their end, child list]
+        self.pending = None     # (element type, header size, data size) of a partly received element
+        self.held = 0           # bytes parsed since the last attribute was handed out
+        self.discard = False    # overflowed or malformed, the rest of the stream is dropped
+
+    def idle(self):
+        '''
+        True when there is no partial element or open sequence.
+        '''
+        return self.count == 0 and not self.stack and self.pending is None and not self.discard
+
+    def feed(self, data):
+        '''
+        Add the bytes of data to the stream and parse all the elements they
+        complete.  Returns the list of (attribute id, value node) attributes
+        completed.
+        '''
+        size = len(data)
+        if self.discard:
+            self.dropped += size
+            return []
+        if self.held + self.count + size > self.max_buffered:
+            self.error = "overflow, more than " + str(self.max_buffered) + " bytes held"
+            self.dropped += self.held + self.count + size
+            self.reset()
+            self.discard = True
+            return []
+        capacity = len(self.buffer)
+        if self.count + size > capacity:
+            self.grow(self.count + size)
+            capacity = len(self.buffer)
+        write_pos = self.read_pos + self.count
+        if write_pos >= capacity:
+            write_pos -= capacity
+        first = min(size, capacity - write_pos)
+        self.view[write_pos:write_pos + first] = data[:first]
+        if first < size:
+            self.view[0:size - first] = data[first:]
+        self.count += size
+        return self.parse()
+
+    def grow(self, needed):
+        capacity = len(self.buffer)
+        while capacity < needed:
+            capacity *= 2
+        buffer = bytearray(capacity)
+        buffer[0:self.count] = self.peek(0, self.count)
+        self.view.release()
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.read_pos = 0
+
+    def peek(self, index, size):
+        '''
+        Returns size bytes starting index bytes past the read position, as a
+        view into the ring buffer unless they wrap around its end.
+        '''
+        capacity = len(self.buffer)
+        start = self.read_pos + index
+        if start >= capacity:
+            start -= capacity
+        end = start + size
+        if end <= capacity:
+            return self.view[start:end]
+        return bytes(self.view[start:]) + bytes(self.view[0:end - capacity])
+
+    def consume(self, size):
+        self.read_pos += size
+        if self.read_pos >= len(self.buffer):
+            self.read_pos -= len(self.buffer)
+        self.count -= size
+        self.offset += size
+        self.held += size
+
+    def element_value(self, element_type, data):
+        if element_type == 1 or element_type == 3:
+            return int.from_bytes(data, 'big')
+        if element_type == 2:
+            return int.from_bytes(data, 'big', signed=True)
+        if element_type == 4 or element_type == 8:
+            return bytes(data).decode('utf-8', 'replace')
+        if element_type == 5:
+            return data[0] != 0
+        return None
+
+    def parse(self):
+        attributes = []
+        descriptor_table = self.s_descriptor_table
+        while True:
+            if self.pending is None:
+                if self.count == 0:
+                    break
+                descriptor = self.buffer[self.read_pos]
+                entry = descriptor_table[descriptor]
+                if entry is None:
+                    self.error = "bad data element descriptor " + hex(descriptor) + " at offset " + str(self.offset)
+                    self.reset()
+                    self.discard = True
+                    break
+                element_type, data_size = entry
+                header_size = 1
+                if data_size < 0:
+                    header_size -= data_size
+                    if self.count < header_size:
+                        break
+                    data_size = int.from_bytes(self.peek(1, header_size - 1), 'big')
+                self.pending = (element_type, header_size, data_size)
+            else:
+                element_type, header_size, data_size = self.pending
+
+            if element_type == 6 or element_type == 7:
+                # sequences complete when their last child does, only the header is needed
+                if len(self.stack) >= self.s_max_depth:
+                    self.error = "sequences nested too deep at offset " + str(self.offset)
+                    self.reset()
+                    self.discard = True
+                    break
+                self.consume(header_size)
+                self.pending = None
+                node = (element_type, [])
+                if self.stack:
+                    self.stack[-1][1].append(node)
+                self.stack.append((self.offset + data_size, node[1]))
+                if data_size:
+                    continue
+            else:
+                if self.count < header_size + data_size:
+                    break
+                node = (element_type, self.element_value(element_type, self.peek(header_size, data_size)))
+                self.consume(header_size + data_size)
+                self.pending = None
+                if self.stack:
+                    self.stack[-1][1].append(node)
+                    self.check_attribute(attributes)
+
+            # close the sequences this element completed
+            while self.stack and self.offset >= self.stack[-1][0]:
+                self.stack.pop()
+                if self.stack:
+                    self.check_attribute(attributes)
+        return attributes
+
+    def check_attribute(self, attributes):
+        # the last child of the innermost open sequence just completed
+        if len(self.stack) == self.attribute_depth:
+            children = self.stack[-1][1]
+            if not (len(children) & 1):
+                attribute_id = children[-2][1]
+                attributes.append((attribute_id, children[-1]))
+                # the pair has been handed out, the tree does not need to keep it
+                del children[-2:]
+                self.held = 0
+
+    def element_to_str(self, node, base=16):
+        element_type, value = node
+        if element_type == 6 or element_type == 7:
+            text = " {C" if element_type == 6 else " {A"
+            for child in value:
+                text += self.element_to_str(child, base)
+            return text + " }"
+        text = " " + self.s_element_type_names.get(element_type, '(' + hex(element_type) + ')')
+        if element_type == 4 or element_type == 8 or value is None:
+            return text + str(value)
+        return text + (hex(value) if base == 16 else str(value))
+
+
+#--------------------------------------------------------------------------
+# HCI ACL reassembly
+#--------------------------------------------------------------------------
+class ACLReassembler:
+    '''
+    Puts L2CAP frames back together from the HCI ACL data packets carrying
+    them, for one direction of the HCI ACL endpoint.
+
+    An ACL packet longer than the endpoint's max packet size spans several
+    USB transactions, and an L2CAP frame longer than the controller's ACL
+    buffers spans several ACL packets: a start fragment (packet boundary
+    flag 0 or 2) and continuation fragments (flag 1).  Fragments are copied
+    into one buffer per connection handle, allocated once and only grown for
+    a larger frame, and the frame is handed out once it is complete.
+    '''
+    s_hci_header = struct.Struct('<HH')
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        # the ACL packet being collected from USB transactions
+        self.packet = bytearray(capacity)
+        self.packet_length = 0
+        self.packet_needed = 0
+        # handle: [buffer, length, needed] of the L2CAP frame being collected
+        self.handles = {}
+        # what the last add() left unfinished, for the text of the transaction
+        self.progress = None
+
+    def add(self, data):
+        '''
+        Add the payload of one USB transaction.  Returns the HCI ACL header
+        followed by a complete L2CAP frame, None while more is due (progress
+        then says what is missing).
+        '''
+        self.progress = None
+        if self.packet_needed:
+            # the ACL packet continues in this transaction
+            length = self.packet_length
+            needed = self.packet_needed
+            size = min(len(data), needed - length)
+            self.packet[length:length + size] = data[:size]
+            length += size
+            if length < needed:
+                self.packet_length = length
+                self.progress = ("ACL packet", self.s_hci_header.unpack_from(self.packet)[0] & 0x0FFF, length, needed)
+                return None
+            self.packet_needed = 0
+            acl = memoryview(self.packet)[:length]
+        elif len(data) < 4:
+            return data
+        else:
+            needed = 4 + self.s_hci_header.unpack_from(data)[1]
+            if len(data) >= needed:
+                acl = data
+            else:
+                # the rest of the ACL packet follows in the next transactions
+                if needed > len(self.packet):
+                    self.packet = bytearray(needed)
+                self.packet[0:len(data)] = data
+                self.packet_length = len(data)
+                self.packet_needed = needed
+                self.progress = ("ACL packet", self.s_hci_header.unpack_from(data)[0] & 0x0FFF, len(data), needed)
+                return None
+        return self.add_fragment(acl)
+
+    def add_fragment(self, acl):
+        handle_flags, hci_length = self.s_hci_header.unpack_from(acl)
+        handle = handle_flags & 0x0FFF
+        fragment = acl[4:4 + hci_length]
+        state = self.handles.get(handle)
+        if (handle_flags >> 12) & 0x03 == 1:
+            # continuation fragment
+            if state is None or not state[2]:
+                self.progress = ("orphan fragment", handle, len(fragment), 0)
+                return None
+            buffer, length, needed = state
+            size = min(len(fragment), needed - length)
+            buffer[length:length + size] = fragment[:size]
+            length += size
+            if length < needed:
+                state[1] = length
+                self.progress = ("L2CAP fragment", handle, length - 4, needed - 4)
+                return None
+            state[1] = 0
+            state[2] = 0
+            # the header of the reassembled packet gets the length of the whole frame
+            buffer[2:4] = (length - 4).to_bytes(2, 'little')
+            return memoryview(buffer)[:length]
+        # start fragment, a frame still being collected on the handle is lost
+        if len(fragment) < 4:
+            return acl
+        needed = 4 + 4 + fragment[0] + (fragment[1] << 8)
+        if 4 + len(fragment) >= needed:
+            if state is not None:
+                state[2] = 0
+            return acl
+        if state is None:
+            state = [bytearray(max(self.capacity, needed)), 0, 0]
+            self.handles[handle] = state
+        elif needed > len(state[0]):
+            state[0] = bytearray(needed)
+        buffer = state[0]
+        buffer[0:4] = acl[0:4]
+        buffer[4:4 + len(fragment)] = fragment
+        state[1] = 4 + len(fragment)
+        state[2] = needed
+        self.progress = ("L2CAP fragment", handle, len(fragment), needed - 4)
+        return None
+
+    def pending(self):
+        '''
+        Returns the progress of the ACL packet or L2CAP frame still being
+        collected, like add() leaves it, None when nothing is.
+        '''
+        if self.packet_needed:
+            handle = self.s_hci_header.unpack_from(self.packet)[0] & 0x0FFF
+            return ("ACL packet", handle, self.packet_length, self.packet_needed)
+        for handle, state in self.handles.items():
+            if state[2]:
+                return ("L2CAP fragment", handle, state[1] - 4, state[2] - 4)
+        return None
+
+    def buffered_bytes(self):
+        return len(self.packet) + sum(len(state[0]) for state in self.handles.values())
+
+
+#--------------------------------------------------------------------------
+# Per endpoint transaction state
+#--------------------------------------------------------------------------
+class EndpointState:
+    '''
+    Transaction state of one (device address, endpoint) pair.  One object is
+    kept per pair for the life of the analyzer and reused for every
+    transaction on it, so traffic to several devices behind a hub does not
+    share or clobber the state of another device.
+    '''
+    __slots__ = ('addr', 'endpoint', 'pid', 'start_time', 'end_time', 'wanted', 'data', 'has_data', 'ack', 'text',
+                 'text_parts', 'text_size', 'processing_report_data', 'control', 'address', 'decoder', 'cacheable', 'decoded', 'transfer_type', 'max_packet', 'aggregate',
+                 'last_pid', 'last_ack', 'last_data', 'repeats', 'repeat_start_time', 'repeat_end_time')
+
+    def __init__(self, addr, endpoint):
+        # addr and endpoint are kept as reported by the addrendp frame
+        self.addr = addr
+        self.endpoint = endpoint
+        # both are emptied, not replaced, for every transaction.  The text of wchar
+        # frames is joined once when the transaction completes.
+        self.data = bytearray()
+        self.text_parts = []
+        self.start_transaction(None, None)
+        # control transfer in progress (endpoint 0 only)
+        self.control = None
+        # the endpoint address (bit 7 set for IN) the state was configured for, the class
+        # decoder for the payloads, see Hla.endpoint_decoder(), and the transfer type and
+        # wMaxPacketSize from the endpoint descriptor (None and 0 when not seen)
+        self.address = None
+        self.decoder = None
+        self.cacheable = True
+        # text of the stateful decoder for the transaction being completed
+        self.decoded = None
+        self.transfer_type = None
+        self.max_packet = 0
+        # bulk packets being summed up (Bulk Transfers setting)
+        self.aggregate = None
+        # the last transaction shown, and how many identical ones followed it
+        self.last_pid = None
+        self.last_ack = None
+        self.last_data = bytearray()
+        self.repeats = 0
+        self.repeat_start_time = None
+        self.repeat_end_time = None
+
+    def start_transaction(self, pid, start_time, wanted=True):
+        self.pid = pid
+        self.start_time = start_time
+        self.end_time = start_time
+        # passes the filters: shown and written out, not only followed for the state it changes
+        self.wanted = wanted
+        self.data.clear()
+        self.has_data = False
+        self.ack = None
+        self.text = None
+        self.text_parts.clear()
+        self.text_size = 0
+        self.processing_report_data = False
+
+
+class ControlTransfer:
+    '''
+    A control transfer being put back together from its SETUP, data stage and
+    status stage transactions.  The data stage payload is collected in one
+    buffer, so descriptors and the like can be decoded as a whole.
+    '''
+    __slots__ = ('addr', 'endpoint', 'setup', 'data', 'text', 'start_time', 'end_time', 'max_packet',
+                 'status_stage', 'status', 'wanted')
+
+    def __init__(self, ep_state):
+        self.addr = ep_state.addr
+        self.endpoint = ep_state.endpoint
+        self.setup = bytes(ep_state.data[:8])
+        self.data = bytearray()
+        self.text = None
+        self.start_time = ep_state.start_time
+        self.end_time = ep_state.end_time
+        # largest data packet seen, a shorter one ends the data stage
+        self.max_packet = 0
+        self.status_stage = self.wLength == 0
+        self.status = None
+        # the transfer is shown when its SETUP passes the filters
+        self.wanted = ep_state.wanted
+
+    @property
+    def device_to_host(self):
+        return len(self.setup) > 0 and (self.setup[0] & 0x80) != 0
+
+    @property
+    def wLength(self):
+        if len(self.setup) < 8:
+            return 0
+        return self.setup[6] + (self.setup[7] << 8)
+
+    # token of the data stage transactions, and of the status stage one
+    def data_pid(self):
+        return "IN" if self.device_to_host else "OUT"
+
+    def status_pid(self):
+        return "OUT" if self.device_to_host and self.wLength else "IN"
+
+
+class BulkAggregate:
+    '''
+    Consecutive accepted (ACK or NYET) bulk packets in one direction on an
+    endpoint, summed up into one frame.  Only the first bytes are kept for
+    display, the others just go into the byte count and the running CRC-32.
+    '''
+    __slots__ = ('pid', 'start_time', 'end_time', 'packets', 'size', 'crc', 'head')
+
+    def __init__(self, pid, start_time):
+        self.pid = pid
+        self.start_time = start_time
+        self.end_time = start_time
+        self.packets = 0
+        self.size = 0
+        self.crc = 0
+        self.head = bytearray()
+
+    def add(self, packet, end_time, head_size):
+        if len(self.head) < head_size:
+            self.head += packet[:head_size - len(self.head)]
+        self.crc = zlib.crc32(packet, self.crc)
+        self.packets += 1
+        self.size += len(packet)
+        self.end_time = end_time
+
+
+#--------------------------------------------------------------------------
+# Descriptors seen during enumeration
+#--------------------------------------------------------------------------
+class DeviceDescriptors:
+    '''
+    The device and configuration descriptors read from one device address,
+    and what its endpoints are used for according to them.
+    '''
+    __slots__ = ('addr', 'device', 'configuration', 'endpoints', 'endpoint_interfaces', 'report_descriptors')
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.device = None
+        self.configuration = None
+        # endpoint address (bEndpointAddress, bit 7 set for IN): (interface class, subclass, protocol,
+        # decoder key, transfer type, wMaxPacketSize)
+        self.endpoints = {}
+        # endpoint address: bInterfaceNumber
+        self.endpoint_interfaces = {}
+        # bInterfaceNumber: HIDReportDescriptor
+        self.report_descriptors = {}
+
+
+#--------------------------------------------------------------------------
+# Optional instrumentation
+#--------------------------------------------------------------------------
+class DecodeStats:
+    '''
+    Counters kept when the Instrumentation setting is on: decode() calls and
+    time per frame type, packets, bytes and NAKs per (address, endpoint), and
+    the bus traffic per time window with a histogram of the window throughput.
+    '''
+    def __init__(self, window):
+        self.window = window
+        self.frame_counts = {}
+        self.frame_seconds = {}
+        # (addr, endpoint): [packets, bytes, naks]
+        self.endpoints = {}
+        self.window_start = None
+        self.window_end = None
+        self.window_packets = 0
+        self.window_bytes = 0
+        self.window_naks = 0
+        # bucket: windows, bucket n holds throughputs below 2**n bytes/s (0: idle)
+        self.histogram = {}
+
+    def count_frame(self, frame_type, seconds):
+        self.frame_counts[frame_type] = self.frame_counts.get(frame_type, 0) + 1
+        self.frame_seconds[frame_type] = self.frame_seconds.get(frame_type, 0.0) + seconds
+
+    def count_transaction(self, key, size, nak):
+        counters = self.endpoints.get(key)
+        if counters is None:
+            counters = [0, 0, 0]
+            self.endpoints[key] = counters
+        counters[0] += 1
+        counters[1] += size
+        self.window_packets += 1
+        self.window_bytes += size
+        if nak:
+            counters[2] += 1
+            self.window_naks += 1
+
+    # Close the current window, returns (start, end, packets, bytes, naks, bytes/s)
+    def close_window(self, skipped=0):
+        bytes_per_sec = self.window_bytes / self.window
+        bucket = int(bytes_per_sec).bit_length()
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+        if skipped:
+            # windows without a single frame in them
+            self.histogram[0] = self.histogram.get(0, 0) + skipped
+        result = (self.window_start, self.window_end, self.window_packets, self.window_bytes, self.window_naks,
+                  bytes_per_sec)
+        self.window_packets = 0
+        self.window_bytes = 0
+        self.window_naks = 0
+        return result
+
+    # Report records ('stats' kind) for everything counted
+    def records(self):
+        for frame_type in sorted(self.frame_counts):
+            yield ('frame', frame_type, self.frame_counts[frame_type], '', '', self.frame_seconds[frame_type])
+        for (addr, endpoint), (packets, size, naks) in sorted(self.endpoints.items()):
+            yield ('endpoint', str(addr) + '/' + str(endpoint), packets, size, naks, '')
+        for bucket in sorted(self.histogram):
+            yield ('histogram', '<' + str(1 << bucket) + ' B/s' if bucket else 'idle', self.histogram[bucket], '', '',
+                   self.window)
+
+
+#--------------------------------------------------------------------------
+# HID report descriptors
+#--------------------------------------------------------------------------
+class HIDReportDescriptor:
+    '''
+    A HID report descriptor compiled into the input report fields it
+    describes.  The descriptor is walked once; decoding a report then takes
+    one int conversion of the report and a shift and mask per field.
+
+    Fields are (name, kind, shift, mask, sign bit, count, size, base usage)
+    tuples, kind one of:
+        0   a single value, signed when sign bit is not 0
+        1   report count 1 bit values shown as one bit mask (buttons, ...)
+        2   an array of count size bit usage indexes (keyboard keys, ...)
+    '''
+    # (usage page, usage): name
+    s_usage_names = {
+        (0x01, 0x30): "X",
+        (0x01, 0x31): "Y",
+        (0x01, 0x32): "Z",
+        (0x01, 0x33): "Rx",
+        (0x01, 0x34): "Ry",
+        (0x01, 0x35): "Rz",
+        (0x01, 0x36): "Slider",
+        (0x01, 0x37): "Dial",
+        (0x01, 0x38): "Wheel",
+        (0x01, 0x39): "Hat",
+        (0x0C, 0x238): "AC Pan",
+        (0x0C, 0xE0): "Volume",
+        (0x0D, 0x30): "Pressure",
+        (0x0D, 0x42): "Tip",
+        (0x0D, 0x44): "Barrel",
+        (0x0D, 0x51): "Contact ID",
+        (0x0D, 0x54): "Contact Count",
+    }
+    # usage page: name of its 1 bit values as a bit mask, or of its arrays
+    s_bit_mask_names = {
+        0x07: "Modifiers",
+        0x08: "LEDs",
+        0x09: "Buttons",
+    }
+    s_array_names = {
+        0x07: "Keys",
+        0x0C: "Consumer",
+    }
+
+    def __init__(self, descriptor):
+        # report id (0 when the descriptor uses none): [report size in bytes, fields]
+        self.reports = {}
+        self.uses_report_ids = False
+        self.error = None
+        self.compile(descriptor)
+
+    def usage_name(self, usage):
+        page = usage >> 16
+        usage_id = usage & 0xFFFF
+        name = self.s_usage_names.get((page, usage_id))
+        if name is not None:
+            return name
+        if page == 0x09:
+            return "Button " + str(usage_id)
+        return hex(page) + ":" + hex(usage_id)
+
+    def compile(self, descriptor):
+        usage_page = 0
+        logical_min = 0
+        report_size = 0
+        report_count = 0
+        report_id = 0
+        global_stack = []
+        usages = []
+        usage_min = None
+        usage_max = None
+        # report id: input report bits so far
+        report_bits = {}
+        index = 0
+        while index < len(descriptor):
+            prefix = descriptor[index]
+            if prefix == 0xFE:
+                # long item, none are defined
+                if index + 1 >= len(descriptor):
+                    break
+                index += 3 + descriptor[index + 1]
+                continue
+            size = (0, 1, 2, 4)[prefix & 0x03]
+            if index + 1 + size > len(descriptor):
+                self.error = "truncated item at offset " + str(index)
+                break
+            data = int.from_bytes(descriptor[index + 1:index + 1 + size], 'little')
+            item = prefix & 0xFC
+            index += 1 + size
+
+            if item == 0x04:    # Usage Page
+                usage_page = data
+            elif item == 0x14:  # Logical Minimum
+                logical_min = data - (1 << (8 * size)) if size and data >> (8 * size - 1) else data
+            elif item == 0x74:  # Report Size
+                report_size = data
+            elif item == 0x94:  # Report Count
+                report_count = data
+            elif item == 0x84:  # Report ID
+                report_id = data
+                self.uses_report_ids = True
+            elif item == 0xA4:  # Push
+                global_stack.append((usage_page, logical_min, report_size, report_count, report_id))
+            elif item == 0xB4:  # Pop
+                if global_stack:
+                    usage_page, logical_min, report_size, report_count, report_id = global_stack.pop()
+            elif item == 0x08:  # Usage, the page may be given in the high 16 bits
+                usages.append(data if size == 4 else (usage_page << 16) | data)
+            elif item == 0x18:  # Usage Minimum
+                usage_min = data if size == 4 else (usage_page << 16) | data
+            elif item == 0x28:  # Usage Maximum
+                usage_max = data if size == 4 else (usage_page << 16) | data
+            elif item & 0x0C == 0:
+                # main item: Input, Output, Feature, Collection, End Collection
+                if item == 0x80 and report_size:
+                    offset = report_bits.get(report_id, 0)
+                    if not data & 0x01:
+                        # not a constant (padding) field
+                        self.add_fields(report_id, offset, data, usage_page, logical_min, report_size, report_count,
+                                        usages, usage_min, usage_max)
+                    report_bits[report_id] = offset + report_size * report_count
+                # local items only last until the next main item
+                usages = []
+                usage_min = None
+                usage_max = None
+
+        for report_id, bits in report_bits.items():
+            report = self.reports.setdefault(report_id, [0, []])
+            report[0] = (bits + 7) // 8
+
+    def add_fields(self, report_id, offset, flags, usage_page, logical_min, report_size, report_count,
+                   usages, usage_min, usage_max):
+        fields = self.reports.setdefault(report_id, [0, []])[1]
+        mask = (1 << report_size) - 1
+        if not flags & 0x02:
+            # array: each entry is the index of a usage that is on (0: none)
+            base = usage_min if usage_min is not None else (usages[0] if usages else usage_page << 16)
+            name = self.s_array_names.get(base >> 16, "Usages")
+            fields.append((name, 2, offset, mask, 0, report_count, report_size, base))
+            return
+        if report_size == 1 and report_count > 1:
+            page = (usages[0] >> 16) if usages else (usage_min >> 16) if usage_min is not None else usage_page
+            name = self.s_bit_mask_names.get(page, "Bits")
+            fields.append((name, 1, offset, (1 << report_count) - 1, 0, report_count, 1, 0))
+            return
+        sign = 1 << (report_size - 1) if logical_min < 0 else 0
+        for i in range(report_count):
+            if i < len(usages):
+                usage = usages[i]
+            elif usage_min is not None and (usage_max is None or usage_min + i <= usage_max):
+                usage = usage_min + i
+            elif usages:
+                usage = usages[-1]
+            else:
+                usage = usage_page << 16
+            fields.append((self.usage_name(usage), 0, offset + i * report_size, mask, sign, 1, report_size, 0))
+
+    def decode(self, packet, pid=None, addr=None, endpoint=None):
+        '''
+        Returns the named fields of the input report in packet as text, None when
+        the packet is not a report this descriptor describes.  addr and endpoint
+        are not needed, reports carry no state from one to the next.
+        '''
+        if pid == "OUT":
+            # output reports have a layout of their own
+            return None
+        report_id = 0
+        start = 0
+        if self.uses_report_ids:
+            if not packet:
+                return None
+            report_id = packet[0]
+            start = 1
+        report = self.reports.get(report_id)
+        if report is None or len(packet) - start < report[0]:
+            return None
+        bits = int.from_bytes(packet[start:start + report[0]], 'little')
+        text = ["ID:" + str(report_id)] if start else []
+        for name, kind, shift, mask, sign, count, size, base in report[1]:
+            value = (bits >> shift) & mask
+            if kind == 0:
+                if value & sign:
+                    value -= mask + 1
+                text.append(name + ":" + str(value))
+            elif kind == 1:
+                text.append(name + ":" + hex(value))
+            else:
+                entries = []
+                for i in range(count):
+                    entry = (bits >> (shift + i * size)) & mask
+                    if entry:
+                        entries.append(hex((base + entry) & 0xFFFF))
+                text.append(name + ":[" + ' '.join(entries) + "]")
+        return ' '.join(text)
+
+
+#--------------------------------------------------------------------------
+# Buffered report output
+#--------------------------------------------------------------------------
+class ReportWriter:
+    '''
+    Buffered sink for the text report the analyzer produces.
+
+    Records are queued in memory and written out as one batch once
+    flush_lines records are pending or flush_seconds have passed since the
+    last write, so decode() never waits on console or file I/O per frame.
+    write() only counts the records, the time limit is checked by the
+    analyzer's periodic sweep (Hla.sweep_held_frames()).
+    Records are only formatted then: the time fields are queued as the raw
+    frame times and turned into offsets from time_origin on the way out.
+    '''
+    # field names of each record kind, used for the JSON Lines output
+    s_record_fields = {
+        'packet': ('time', 'pid', 'endpoint', 'addr', 'ack', 'text', 'data'),
+        'item': ('time', 'item', 'endpoint', 'addr', 'text'),
+        'repeat': ('time', 'pid', 'endpoint', 'addr', 'ack', 'count', 'duration', 'data'),
+        'bulk': ('time', 'pid', 'endpoint', 'addr', 'packets', 'bytes', 'duration', 'bytes_per_sec', 'crc32', 'data'),
+        'debug': ('text',),
+        'stats': ('scope', 'key', 'count', 'bytes', 'naks', 'seconds'),
+    }
+    # fields shown in the Display Format (hex or decimal) in the text outputs
+    s_int_fields = ('endpoint', 'addr')
+    # time format: units per second of the integer offsets, None for float seconds
+    s_time_scales = {
+        'Seconds': None,
+        'Microseconds': 1000000,
+        'Nanoseconds': 1000000000,
+    }
+
+    def __init__(self, mode, file_name='', base=16, time_format='Seconds', flush_lines=256, flush_seconds=1.0):
+        self.mode = mode
+        int_to_str = hex if base == 16 else str
+        self.field_converters = {kind: tuple(self.time_to_str if name == 'time' else
+                                             int_to_str if name in self.s_int_fields else str for name in fields)
+                                 for kind, fields in self.s_record_fields.items()}
+        self.time_scale = self.s_time_scales[time_format]
+        # the time the offsets are from, the start of the first frame decoded
+        self.time_origin = None
+        self.flush_lines = flush_lines
+        self.flush_seconds = flush_seconds
+        self.pending = []
+        self.next_flush_time = time.monotonic() + flush_seconds
+        self.csv_writer = None
+        if mode == 'Console':
+            self.stream = sys.stdout
+            self.format_record = self.format_text
+        else:
+            if not file_name:
+                raise ValueError("Report Output '" + mode + "' needs a Report File")
+            self.stream = open(file_name, 'w', newline='', encoding='utf-8')
+            if mode == 'CSV File':
+                self.csv_writer = csv.writer(self.stream, delimiter=';')
+                self.format_record = self.format_csv
+            else:
+                self.format_record = self.format_json
+
+    def time_value(self, frame_time):
+        if self.time_origin is None:
+            self.time_origin = frame_time
+        seconds = float(frame_time - self.time_origin)
+        if self.time_scale is None:
+            return seconds
+        return int(round(seconds * self.time_scale))
+
+    def time_to_str(self, frame_time):
+        return str(self.time_value(frame_time))
+
+    def fields_to_str(self, kind, values):
+        return [convert(value) for convert, value in zip(self.field_converters[kind], values)]
+
+    def format_text(self, kind, values):
+        return ' ; '.join(self.fields_to_str(kind, values))
+
+    def format_csv(self, kind, values):
+        return [kind] + self.fields_to_str(kind, values)
+
+    def format_json(self, kind, values):
+        record = dict(zip(self.s_record_fields[kind], values))
+        if 'time' in record:
+            record['time'] = self.time_value(record['time'])
+        record['type'] = kind
+        return json.dumps(record)
+
+    def write(self, kind, *values):
+        self.pending.append((kind, values))
+        if len(self.pending) >= self.flush_lines:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            format_record = self.format_record
+            records = [format_record(kind, values) for kind, values in self.pending]
+            if self.csv_writer is not None:
+                self.csv_writer.writerows(records)
+            else:
+                self.stream.write('\n'.join(records))
+                self.stream.write('\n')
+            self.pending.clear()
+            self.stream.flush()
+        self.next_flush_time = time.monotonic() + self.flush_seconds
+
+    def close(self):
+        if self.stream is None:
+            return
+        self.flush()
+        if self.stream is not sys.stdout:
+            self.stream.close()
+        self.stream = None
+
+
+#--------------------------------------------------------------------------
+# pcap export
+#--------------------------------------------------------------------------
+class PcapWriter:
+    '''
+    Streams the transactions into a pcap file with Linux usbmon headers
+    (LINKTYPE_USB_LINUX), which Wireshark and the usual pcap tools read.
+
+    usbmon describes URBs rather than bus transactions, so every transaction
+    becomes a record of its own: a SETUP is a submission carrying the setup
+    packet, anything else a completion with its payload and the handshake as
+    URB status.  Records are packed into a buffer and written out once
+    flush_bytes are pending or flush_seconds have passed, like ReportWriter.
+    '''
+    # pcap file header: magic, version 2.4, time zone, sigfigs, snap length, link type
+    s_file_header = struct.Struct('<IHHiIII')
+    # pcap record header followed by the 48 byte usbmon header
+    s_record_header = struct.Struct('<IIIIQBBBBHccqiiII8s')
+    s_usbmon_header_size = 48
+    s_link_type = 189
+    s_snap_length = 0x40000
+    s_bus = 1
+    # usbmon transfer type by the transfer type of the endpoint descriptor
+    s_transfer_types = {0: 2, 1: 0, 2: 3, 3: 1}
+    # URB status by handshake: 0, -EAGAIN, -EPIPE, anything else -EPROTO
+    s_ack_status = {"ACK": 0, "NYET": 0, "NAK": -11, "STALL": -32}
+    s_error_status = -71
+    # status of a submission still in flight, -EINPROGRESS
+    s_submit_status = -115
+    s_no_setup = bytes(8)
+
+    def __init__(self, file_name, flush_bytes=1 << 16, flush_seconds=1.0):
+        self.stream = open(file_name, 'wb')
+        self.stream.write(self.s_file_header.pack(0xa1b2c3d4, 2, 4, 0, 0, self.s_snap_length, self.s_link_type))
+        # the time the record times are from, the start of the first frame decoded
+        self.time_origin = None
+        self.urb_id = 0
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_seconds
+        self.pending = bytearray()
+        self.next_flush_time = time.monotonic() + flush_seconds
+
+    def write(self, frame_time, pid, addr, endpoint, transfer_type, ack, packet):
+        if self.time_origin is None:
+            self.time_origin = frame_time
+        seconds = float(frame_time - self.time_origin)
+        ts_sec = int(seconds)
+        ts_usec = int((seconds - ts_sec) * 1000000)
+        if endpoint == 0:
+            xfer_type = 2
+        else:
+            # no endpoint descriptor seen: bulk, Wireshark shows the payload as it is
+            xfer_type = self.s_transfer_types.get(transfer_type, 3)
+        if pid == "SETUP":
+            event = 0x53    # 'S'
+            flag_setup = b'\0'
+            setup = bytes(packet[:8]).ljust(8, b'\0')
+            # the direction of a control URB is that of its data stage
+            direction = setup[0] & 0x80
+            # the URB is as long as the data stage it asks for
+            length = setup[6] + (setup[7] << 8)
+            status = self.s_submit_status
+            packet = b''
+        else:
+            event = 0x43    # 'C'
+            direction = 0x80 if pid == "IN" else 0
+            flag_setup = b'-'
+            setup = self.s_no_setup
+            length = len(packet)
+            status = self.s_ack_status.get(ack, self.s_error_status)
+        captured = len(packet)
+        if captured:
+            flag_data = b'\0'
+        else:
+            flag_data = b'<' if direction else b'>'
+        size = self.s_usbmon_header_size + captured
+        pending = self.pending
+        pending += self.s_record_header.pack(ts_sec, ts_usec, size, size, self.urb_id, event, xfer_type,
+                                             endpoint | direction, addr, self.s_bus, flag_setup, flag_data,
+                                             ts_sec, ts_usec, status, length, captured, setup)
+        pending += packet
+        self.urb_id += 1
+        if len(pending) >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.stream.write(self.pending)
+            self.pending.clear()
+            self.stream.flush()
+        self.next_flush_time = time.monotonic() + self.flush_seconds
+
+    def close(self):
+        if self.stream is None:
+            return
+        self.flush()
+        self.stream.close()
+        self.stream = None
+
+
+#--------------------------------------------------------------------------
+# Transaction index (SQLite)
+#--------------------------------------------------------------------------
+class IndexWriter:
+    '''
+    Records every transaction as a row of an SQLite table, so a long capture
+    can be searched with SQL instead of grepping the report.
+
+    Rows are queued and inserted with one executemany() per batch, inside a
+    single database transaction, once flush_rows are pending or flush_seconds
+    have passed.  A table already in the file is replaced.
+    '''
+    s_schema = (
+        'DROP TABLE IF EXISTS transactions',
+        'CREATE TABLE transactions (id INTEGER PRIMARY KEY, time REAL, addr INTEGER, endpoint INTEGER, '
+        'pid TEXT, ack TEXT, request TEXT, l2cap_cmd INTEGER, l2cap_cid INTEGER, length INTEGER, payload BLOB)',
+        'CREATE INDEX transactions_addr_endpoint ON transactions (addr, endpoint)',
+        'CREATE INDEX transactions_request ON transactions (request)',
+    )
+    s_insert = ('INSERT INTO transactions (time, addr, endpoint, pid, ack, request, l2cap_cmd, l2cap_cid, length, payload) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+    def __init__(self, file_name, flush_rows=1000, flush_seconds=1.0):
+        # imported here, the analyzer does not need sqlite3 unless the index is on
+        import sqlite3
+        self.connection = sqlite3.connect(file_name)
+        # the index can be built again from the capture, it is not worth a journal
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('PRAGMA journal_mode = MEMORY')
+        with self.connection:
+            for statement in self.s_schema:
+                self.connection.execute(statement)
+        # the time the row times are from, the start of the first frame decoded
+        self.time_origin = None
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.pending = []
+        self.next_flush_time = time.monotonic() + flush_seconds
+
+    def write(self, frame_time, addr, endpoint, pid, ack, request, l2cap_cmd, l2cap_cid, payload):
+        if self.time_origin is None:
+            self.time_origin = frame_time
+        self.pending.append((float(frame_time - self.time_origin), addr, endpoint, pid, ack, request,
+                             l2cap_cmd, l2cap_cid, len(payload), payload))
+        if len(self.pending) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with self.connection:
+                self.connection.executemany(self.s_insert, self.pending)
+            self.pending.clear()
+        self.next_flush_time = time.monotonic() + self.flush_seconds
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.flush()
+        self.connection.close()
+        self.connection = None
 
 
 # High level analyzers must subclass the HighLevelAnalyzer class.
@@ -21,11 +1082,62 @@ class Hla(HighLevelAnalyzer):
 
     HCIChannel = NumberSetting(label='HCI Channel', min_value=-1, max_value=3)
 
+    MaxDisplayBytes = NumberSetting(label='Max Display Bytes (0: all)', min_value=0, max_value=65536)
+
+    RenderCacheSize = NumberSetting(label='Render Cache Entries (0: off)', min_value=0, max_value=100000)
+
+    CoalesceRepeats = ChoicesSetting(
+        label='Coalesce Repeats',
+        choices=('Off', 'NAKs', 'NAKs + Repeated Data')
+    )
+
+    AddressFilter = StringSetting(label='Address Filter (e.g. 1,3-5)')
+    EndpointFilter = StringSetting(label='Endpoint Filter (e.g. 0,2)')
+    DirectionFilter = ChoicesSetting(
+        label='Direction Filter',
+        choices=('All', 'IN', 'OUT')
+    )
+    PIDFilter = StringSetting(label='PID Filter (e.g. IN,SETUP)')
+
+    ControlTransfers = ChoicesSetting(
+        label='Control Transfers',
+        choices=('Packets', 'Transfers')
+    )
+
+    BulkTransfers = ChoicesSetting(
+        label='Bulk Transfers',
+        choices=('Packets', 'Aggregate')
+    )
+
+    Instrumentation = ChoicesSetting(
+        label='Instrumentation',
+        choices=('Off', 'Final Report', 'Periodic Frames')
+    )
+    StatsWindow = NumberSetting(label='Stats Window ms (0: 100)', min_value=0, max_value=60000)
+
+    ReportOutput = ChoicesSetting(
+        label='Report Output',
+        choices=('Console', 'None', 'CSV File', 'JSON Lines File')
+    )
+
+    ReportFile = StringSetting(label='Report File')
+    ReportTimestamps = ChoicesSetting(
+        label='Report Timestamps',
+        choices=('Seconds', 'Microseconds', 'Nanoseconds')
+    )
+
+    PcapFile = StringSetting(label='Pcap File (usbmon, empty: off)')
+    IndexFile = StringSetting(label='Index File (SQLite, empty: off)')
 
     # An optional list of types this analyzer produces, providing a way to customize the way frames are displayed in Logic 2.
     result_types = {
         'USB': {'format': '{{data.pid}}({{data.addr}},{{data.endpoint}},{{data.ack}}) {{data.data}}'},
         'USB Text': {'format': '{{data.pid}}({{data.addr}},{{data.endpoint}}) "{{data.text}}"'},
+        'USB Repeat': {'format': '{{data.pid}}({{data.addr}},{{data.endpoint}},{{data.ack}}) x{{data.count}} in {{data.duration}}s {{data.data}}'},
+        'USB Overflow': {'format': '{{data.what}} overflow, {{data.dropped}} dropped'},
+        'USB Stats': {'format': '{{data.packets}} packets {{data.bytes}} bytes {{data.naks}} NAKs {{data.bytes_per_sec}} B/s'},
+        'USB Bulk': {'format': '{{data.pid}}({{data.addr}},{{data.endpoint}}) {{data.packets}} packets {{data.bytes}} bytes in {{data.duration}}s {{data.bytes_per_sec}} B/s crc32 {{data.crc32}} {{data.data}}'},
+        'USB Transfer': {'format': '{{data.pid}}({{data.addr}},{{data.endpoint}},{{data.ack}}) {{data.text}} {{data.data}}'},
 
     }
     #--------------------------------------------------------------------------
@@ -64,24 +1176,222 @@ class Hla(HighLevelAnalyzer):
         0XB: "DATC [DEPRECATED]"
     }
 
-    s_sdp_data_element_types = {
-        0x0: "(Nil)",
-        0x1: "(UINT)",
-        0x2: "(INT)",
-        0x3: "(UUID)",
-        0x4: "(STR)",
-        0x5: "(BOOL)",
-        0x6: "(SEQ)",
-        0x7: "(ALT)",
-        0x8: "(URL)"
-    }
     s_psm_names = {
         0x01: "(SDP)",
         0x11: "(CTRL)",
         0x13: "(INT)"
     }
+    s_l2cap_info_types = {
+        1: "(Connectionless MTU)",
+        2: "(Extended fetures supported)",
+        3: "(Fixed channels supported)"
+    }
+
+    # HCI ACL header (handle + flags, length) followed by the L2CAP basic header
+    # (length, channel id), all little endian
+    s_hci_l2cap_header = struct.Struct('<HHHH')
+    # L2CAP signaling command header (code, identifier, length), at offset 8
+    s_l2cap_command_header = struct.Struct('<BBH')
+    # L2CAP signaling command parameters, at offset 12
+    s_l2cap_command_layouts = {
+        0x01: struct.Struct('<H'),      # COMMAND_REJECT: reason
+        0x02: struct.Struct('<HH'),     # CONNECTION_REQUEST: PSM, SCID
+        0x03: struct.Struct('<HHHH'),   # CONNECTION_RESPONSE: DCID, SCID, result, status
+        0x04: struct.Struct('<HH'),     # CONFIG_REQUEST: DCID, flags
+        0x05: struct.Struct('<HHH'),    # CONFIG_RESPONSE: SCID, flags, result
+        0x06: struct.Struct('<HH'),     # DISCONNECT_REQUEST: DCID, SCID
+        0x07: struct.Struct('<HH'),     # DISCONNECT_RESPONSE: DCID, SCID
+        0x0A: struct.Struct('<H'),      # INFORMATION_REQUEST: info type
+        0x0B: struct.Struct('<HH')      # INFORMATION_RESPONSE: info type, result
+    }
+
+    # Byte to display string tables, indexed by the byte value.  Each entry
+    # carries its leading separator so a packet renders with a single join.
+    s_byte_str_dec = tuple(' ' + str(b) for b in range(256))
+    s_byte_str_hex = tuple(' ' + hex(b) for b in range(256))
+
+    s_handshake_pids = frozenset(("ACK", "NAK", "STALL", "NYET"))
+    s_token_pids = frozenset(("IN", "OUT", "SETUP"))
+    # pid frame value: what decode_pid() does with it, data PIDs (DATA0, ...) are not needed
+    s_pid_kinds = dict([(pid, "token") for pid in s_token_pids] + [(pid, "handshake") for pid in s_handshake_pids])
+    # a repeat summary is emitted at least every this many coalesced transactions, and once
+    # the run is this old
+    s_max_repeats = 10000
+    s_max_repeat_seconds = 0.5
+
+    # longest string descriptor text kept for one transaction
+    s_max_text = 4096
+
+    # bytes of an aggregated bulk transfer shown, when Max Display Bytes does not say
+    s_bulk_head_size = 64
+    # an aggregate is also shown once it has this many packets, or its endpoint has been idle this long
+    s_bulk_max_packets = 4096
+    s_bulk_idle_seconds = 0.1
+    # frames held back (repeats, bulk aggregates) are looked at every this many seconds of
+    # capture time, see sweep_held_frames()
+    s_sweep_seconds = 0.1
+
+    # longest payload whose rendering is cached, bulk data rarely repeats
+    s_render_cache_max_payload = 64
+
+    #--------------------------------------------------------------------------
+    # SETUP request decoding tables
+    #--------------------------------------------------------------------------
+    # descriptor type, the high byte of wValue for GET_DESCRIPTOR/SET_DESCRIPTOR
+    s_descriptor_types = {
+        0x01: "DEVICE",
+        0x02: "CONFIG",
+        0x03: "STRING",
+        0x04: "INTERFACE",
+        0x05: "ENDPOINT",
+        0x06: "DEVICE_QUALIFIER",
+        0x07: "OTHER_SPEED_CONFIG",
+        0x08: "INTERFACE_POWER",
+        0x0F: "BOS",
+        0x21: "HID",
+        0x22: "HID REPORT",
+        0x23: "HID PHYSICAL",
+        0x29: "HUB",
+        0x2A: "SS_HUB"
+    }
+    s_standard_features = {
+        0: " ENDPOINT_HALT",
+        1: " DEVICE_REMOTE_WAKEUP",
+        2: " TEST_MODE"
+    }
+    s_hub_features = {
+        0: " C_HUB_LOCAL_POWER",
+        1: " C_HUB_OVER_CURRENT"
+    }
+    s_hub_port_features = {
+        0: " CONNECTION",
+        1: " ENABLE",
+        2: " SUSPEND",
+        3: " OVER_CURRENT",
+        4: " RESET",
+        8: " POWER",
+        9: " LOW_SPEED",
+        16: " C_CONNECTION",
+        17: " C_ENABLE",
+        18: " C_SUSPEND",
+        19: " C_OVER_CURRENT",
+        20: " C_RESET",
+        21: " TEST",
+        22: " INDICATOR"
+    }
+    s_hid_report_types = {
+        1: " INPUT",
+        2: " OUTPUT",
+        3: " FEATURE"
+    }
+    s_hid_protocols = {
+        0: " BOOT",
+        1: " REPORT"
+    }
+
+    # Formatters for the part of the text following the request name. They are
+    # called as formatter(self, wValue, wIndex) from the s_setup_requests table.
+    def setup_descriptor_text(self, wValue, wIndex):
+        descriptor_type = wValue >> 8
+        if descriptor_type in self.s_descriptor_types:
+            return " " + self.s_descriptor_types[descriptor_type] + " #:" + str(wValue & 0xff)
+        return ' <?? ' + hex(descriptor_type)
+
+    def setup_value_text(self, wValue, wIndex):
+        return " #:" + str(wValue)
+
+    def setup_feature_text(self, wValue, wIndex):
+        return self.s_standard_features.get(wValue, ' ' + hex(wValue))
+
+    def setup_hub_feature_text(self, wValue, wIndex):
+        return self.s_hub_features.get(wValue, ' ' + hex(wValue))
+
+    def setup_port_feature_text(self, wValue, wIndex):
+        return hex(wIndex) + " Feature:" + self.s_hub_port_features.get(wValue, ' ' + hex(wValue))
+
+    def setup_port_text(self, wValue, wIndex):
+        return hex(wIndex & 0xff)
+
+    def setup_port_status_text(self, wValue, wIndex):
+        return hex(wIndex) + " status"
+
+    def setup_hid_report_text(self, wValue, wIndex):
+        report_type = wValue >> 8
+        if report_type in self.s_hid_report_types:
+            return self.s_hid_report_types[report_type] + " # " + str(wValue & 0xff)
+        return '?? '
+
+    def setup_hid_protocol_text(self, wValue, wIndex):
+        return self.s_hid_protocols.get(wValue, ' ' + hex(wValue))
+
+    # (bmRequestType, bRequest): (request name, formatter or None)
+    s_setup_requests = {
+        # Standard requests
+        (0x80, 0x00): ("GET_STATUS - DEVICE", None),
+        (0x81, 0x00): ("GET_STATUS - INTERFACE", None),
+        (0x82, 0x00): ("GET_STATUS - ENDPOINT", None),
+        (0x00, 0x01): ("CLEAR_FEATURE - DEVICE", setup_feature_text),
+        (0x01, 0x01): ("CLEAR_FEATURE - INTERFACE", setup_feature_text),
+        (0x02, 0x01): ("CLEAR_FEATURE - ENDPOINT", setup_feature_text),
+        (0x00, 0x03): ("SET_FEATURE - DEVICE", setup_feature_text),
+        (0x01, 0x03): ("SET_FEATURE - INTERFACE", setup_feature_text),
+        (0x02, 0x03): ("SET_FEATURE - ENDPOINT", setup_feature_text),
+        (0x00, 0x05): ("SET_ADDRESS", setup_value_text),
+        (0x80, 0x06): ("GET_DESCRIPTOR -", setup_descriptor_text),
+        (0x00, 0x07): ("SET_DESCRIPTOR -", setup_descriptor_text),
+        (0x80, 0x08): ("GET_CONFIGURATION", None),
+        (0x00, 0x09): ("SET_CONFIGURATION", setup_value_text),
+        (0x81, 0x0A): ("GET_INTERFACE", None),
+        (0x01, 0x0B): ("SET_INTERFACE", setup_value_text),
+        (0x82, 0x0C): ("SYNCH_FRAME", None),
+        # HID class requests
+        (0x81, 0x06): ("GET_DESCRIPTOR -", setup_descriptor_text),
+        (0x01, 0x07): ("SET_DESCRIPTOR -", setup_descriptor_text),
+        (0xA1, 0x01): ("GET_REPORT -", setup_hid_report_text),
+        (0xA1, 0x02): ("HID GET_IDLE", None),
+        (0xA1, 0x03): ("HID GET_PROTOCOL", None),
+        (0x21, 0x09): ("HID SET_REPORT -", setup_hid_report_text),
+        (0x21, 0x0A): ("HID SET_IDLE", None),
+        (0x21, 0x0B): ("HID SET_PROTOCOL", setup_hid_protocol_text),
+        # Hub class requests
+        (0xA0, 0x00): ("HUB Get status", None),
+        (0xA3, 0x00): ("HUB Get Port:", setup_port_status_text),
+        (0x20, 0x01): ("HUB Clear Feature:", setup_hub_feature_text),
+        (0x23, 0x01): ("HUB Clear port:", setup_port_feature_text),
+        (0x20, 0x03): ("HUB Set Feature:", setup_hub_feature_text),
+        (0x23, 0x03): ("HUB Set port:", setup_port_feature_text),
+        (0xA0, 0x06): ("HUB GET_DESCRIPTOR -", setup_descriptor_text),
+        (0x20, 0x07): ("HUB SET_DESCRIPTOR -", setup_descriptor_text),
+        (0x23, 0x08): ("HUB Clear TT Buffer port:", setup_port_text),
+        (0x23, 0x09): ("HUB Reset TT port:", setup_port_text),
+        (0xA3, 0x0A): ("HUB Get TT State port:", setup_port_text),
+        (0x23, 0x0B): ("HUB Stop TT port:", setup_port_text),
+        # CDC ACM class requests
+        (0x21, 0x20): ("CDC SET_LINE_CODING", None),
+        (0xA1, 0x21): ("CDC GET_LINE_CODING", None),
+        (0x21, 0x22): ("CDC SET_CONTROL_LINE_STATE", setup_value_text),
+        (0x21, 0x23): ("CDC SEND_BREAK", setup_value_text),
+        # Mass storage (bulk only) class requests
+        (0xA1, 0xFE): ("MSC GET_MAX_LUN", None),
+        (0x21, 0xFF): ("MSC BULK_ONLY_RESET", None)
+    }
 
 
+    # interface class: decoder key.  Bluetooth (0xE0, 0x01, 0x01) also needs the
+    # endpoint transfer type to tell ACL data from events and SCO.
+    s_interface_classes = {
+        0x02: "cdc",
+        0x03: "hid",
+        0x08: "msc",
+        0x09: "hub",
+        0x0A: "cdc_data",
+    }
+    s_bluetooth_transfer_types = {
+        1: "hci_sco",
+        2: "hci_acl",
+        3: "hci_event",
+    }
+
     #--------------------------------------------------------------------------
     # Class Init function 
     #--------------------------------------------------------------------------
@@ -94,247 +1404,395 @@ class Hla(HighLevelAnalyzer):
             self.base = 16
         elif self.DisplayFormat == 'Dec':
             self.base = 10
+        if self.base == 16:
+            self.byte_str_table = self.s_byte_str_hex
+        else:
+            self.byte_str_table = self.s_byte_str_dec
         self.HCIChannelFixed = int(self.HCIChannel)
-        self.addr = None
-        self.endpoint = None
-        self.frame_start_time = None
-        self.frame_end_time = None
-        self.data_packet_save = None
-        self.text_save = None
-        self.frame_ack_nak = None
-        self.processing_report_data = False
-        #self.frame_data = {'pid':'', 'pid2':''}
-        self.frame_data = {'pid':''}
+        # longer payloads are cut short in the frames, 0 shows them whole
+        self.max_display_bytes = int(self.MaxDisplayBytes)
+        # LRU cache of the rendering of repeated payloads, see transaction_frame()
+        self.render_cache_size = int(self.RenderCacheSize)
+        self.render_cache = OrderedDict() if self.render_cache_size > 0 else None
+        self.render_cache_hits = 0
+        self.render_cache_misses = 0
+        # All: also show the transactions without data (NAKed polls, zero length packets)
+        self.display_all = self.DisplayLevel == 'All'
+        # 0: off, 1: coalesce repeated NAKed transactions, 2: also repeated identical data
+        self.coalesce = ('Off', 'NAKs', 'NAKs + Repeated Data').index(self.CoalesceRepeats)
+        # transaction filters, None when everything passes
+        self.address_filter = self.parse_number_list(self.AddressFilter, 127)
+        self.endpoint_filter = self.parse_number_list(self.EndpointFilter, 15)
+        self.pid_filter = self.parse_pid_list(self.PIDFilter)
+        if self.DirectionFilter == 'IN':
+            self.pid_filter = (self.pid_filter or self.s_token_pids) & {"IN"}
+        elif self.DirectionFilter == 'OUT':
+            self.pid_filter = (self.pid_filter or self.s_token_pids) & {"OUT", "SETUP"}
+        # Transfers: one frame per control transfer instead of one per transaction
+        self.show_transfers = self.ControlTransfers == 'Transfers'
+        # Aggregate: runs of bulk packets become one frame
+        self.aggregate_bulk = self.BulkTransfers == 'Aggregate'
+        self.bulk_head_size = self.max_display_bytes or self.s_bulk_head_size
+        self.filtering = self.address_filter is not None or self.endpoint_filter is not None or \
+            self.pid_filter is not None
+        # frame type: handler, the ones not listed are counted in unknown_frame_types
+        self.frame_handlers = {
+            'pid': self.decode_pid,
+            'data': self.decode_data,
+            'eop': self.decode_eop,
+            'addrendp': self.decode_addrendp,
+            'protocol': self.decode_protocol,
+            'presult': self.decode_presult,
+            'wchar': self.decode_wchar,
+            'wLANGID': self.decode_wchar,
+            'hiditem': self.decode_hiditem,
+        }
+        self.unknown_frame_types = {}
+        # EndpointState per (addr, endpoint), and the one the current transaction is on
+        self.endpoint_states = {}
+        self.ep_state = None
+        # token PID and start time, until the addrendp frame says which endpoint it is for
+        self.token_pid = None
+        self.token_start_time = None
+        # start time of the token the held back frames were last looked at
+        self.sweep_time = None
         self.first_packet_start_time = None;
         #print("Settings:", self.my_string_setting,
         #      self.my_number_setting, self.my_choices_setting)
-        self.parse_data = None
-        self.parse_level_bytes_left = arr.array('l')
-        self.parse_str = ""
+        self.sdp_parsers = {}
         self.map_CID_to_usage = {}
+        # ACLReassembler per (addr, endpoint, token PID): HCI endpoint and direction
+        self.acl_reassemblers = {}
+        # [what, dropped] of the buffers that overflowed during the current transaction,
+        # and the number of overflows per what
+        self.overflows = []
+        self.overflow_counts = {}
+        # DeviceDescriptors per address, and (addr, endpoint address) -> (class, subclass, protocol,
+        # decoder key, transfer type, wMaxPacketSize)
+        self.devices = {}
+        self.endpoint_classes = {}
+        # decoder key: class decoder, see endpoint_decoder()
+        self.class_decoders = {
+            "hci_acl": self.decode_hci_acl,
+        }
+        # HID report descriptor bytes: HIDReportDescriptor, compiled once for all the devices using it
+        self.hid_report_descriptors = {}
+        # (hub address, port) -> the address given to the device last reset on that port
+        self.hub_ports = {}
+        self.reset_port = None
+        if self.Instrumentation == 'Final Report' and self.ReportOutput == 'None':
+            raise ValueError("Instrumentation 'Final Report' needs a Report Output")
+        self.report_writer = None
+        if self.ReportOutput != 'None':
+            self.report_writer = ReportWriter(self.ReportOutput, self.ReportFile, self.base, self.ReportTimestamps)
+        self.pcap_writer = None
+        if self.PcapFile:
+            self.pcap_writer = PcapWriter(self.PcapFile)
+        self.index_writer = None
+        if self.IndexFile:
+            self.index_writer = IndexWriter(self.IndexFile)
+        # (command, channel) of the L2CAP frame decoded last, for the index
+        self.l2cap_frame = None
+        # frames or output records may be held back, see sweep_held_frames()
+        self.writers = [writer for writer in (self.report_writer, self.pcap_writer, self.index_writer)
+                        if writer is not None]
+        self.sweeping = self.aggregate_bulk or self.coalesce != 0 or bool(self.writers)
+        # instrumentation: decode() is only wrapped when it is on, so it costs nothing otherwise
+        self.stats = None
+        self.stats_frames = self.Instrumentation == 'Periodic Frames'
+        self.stats_reported = False
+        if self.Instrumentation != 'Off':
+            self.stats = DecodeStats((self.StatsWindow or 100) / 1000.0)
+            self.decode = self.decode_instrumented
+        # the outputs are closed by whichever comes first, the analyzer going away or Python
+        # exiting.  The hook only holds a weak reference, it does not keep the analyzer alive.
+        self.exit_hook = None
+        if self.writers:
+            self.exit_hook = functools.partial(Hla.close_outputs_at_exit, weakref.ref(self))
+            atexit.register(self.exit_hook)
+
+    def __del__(self):
+        if getattr(self, 'exit_hook', None) is not None:
+            self.close_outputs()
+
+    @staticmethod
+    def close_outputs_at_exit(hla_ref):
+        hla = hla_ref()
+        if hla is not None:
+            hla.close_outputs()
+
+    # The final report of the instrumentation, then the output files closed
+    def close_outputs(self):
+        if self.stats is not None and not self.stats_reported:
+            self.report_stats()
+        for writer in self.writers:
+            writer.close()
+        if self.exit_hook is not None:
+            atexit.unregister(self.exit_hook)
+            self.exit_hook = None
+
+    # Logic 2 never calls this, offline tools (tools/replay.py) do once the last
+    # frame has been decoded.  Returns the frames still held back, if any.
+    def finish(self):
+        frames = [self.repeat_frame(ep_state) for ep_state in self.endpoint_states.values() if ep_state.repeats]
+        for ep_state in self.endpoint_states.values():
+            if ep_state.aggregate is not None:
+                frames.append(self.bulk_frame(ep_state))
+        if self.stats is not None and self.stats.window_start is not None:
+            window_frame = self.stats_window_frame(self.stats.close_window())
+            if self.stats_frames:
+                frames.append(window_frame)
+            if not self.stats_reported:
+                self.report_stats()
+        frames.sort(key=lambda new_frame: new_frame.start_time)
+        if self.report_writer is not None:
+            self.report_writer.flush()
+        if self.pcap_writer is not None:
+            self.pcap_writer.flush()
+        if self.index_writer is not None:
+            self.index_writer.flush()
+        return frames
+
+    # Offline tools also split long captures into parts decoded by separate analyzers
+    # (tools/parallel_decode.py).  A part can start with the next transaction when this is
+    # True: no control transfer, ACL packet or SDP attribute list is left half done, so all
+    # the part needs is what export_state() returns.
+    def at_safe_boundary(self):
+        for ep_state in self.endpoint_states.values():
+            if ep_state.control is not None:
+                return False
+        for parser in self.sdp_parsers.values():
+            if not parser.idle():
+                return False
+        for reassembler in self.acl_reassemblers.values():
+            if reassembler.packet_needed or any(state[2] for state in reassembler.handles.values()):
+                return False
+        return True
+
+    # What was learnt from the capture so far and applies to the rest of it: the
+    # descriptors and addresses of the devices and the L2CAP channels.  Picklable.
+    def export_state(self):
+        return {
+            'first_packet_start_time': self.first_packet_start_time,
+            'devices': self.devices,
+            'endpoint_classes': self.endpoint_classes,
+            'hid_report_descriptors': self.hid_report_descriptors,
+            'hub_ports': self.hub_ports,
+            'reset_port': self.reset_port,
+            'map_CID_to_usage': self.map_CID_to_usage,
+        }
+
+    def import_state(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        for writer in (self.report_writer, self.pcap_writer, self.index_writer):
+            if writer is not None:
+                writer.time_origin = self.first_packet_start_time
+        # endpoints seen before are configured again from the imported descriptors
+        for (addr, endpoint), ep_state in self.endpoint_states.items():
+            self.configure_endpoint(ep_state, addr, ep_state.address)
+
+    # Parse a filter list like "1, 3-5, 0x10" into a frozenset, None when empty
+    def parse_number_list(self, text, max_value):
+        if not text or not text.strip():
+            return None
+        numbers = set()
+        for item in text.replace(' ', '').split(','):
+            if not item:
+                continue
+            first, sep, last = item.partition('-')
+            try:
+                first = int(first, 0)
+                last = int(last, 0) if sep else first
+            except ValueError:
+                raise ValueError("Bad filter entry '" + item + "' in '" + text + "'")
+            if first < 0 or last > max_value or first > last:
+                raise ValueError("Filter entry '" + item + "' must be in the range 0-" + str(max_value))
+            numbers.update(range(first, last + 1))
+        return frozenset(numbers)
+
+    def parse_pid_list(self, text):
+        if not text or not text.strip():
+            return None
+        pids = frozenset(item.strip().upper() for item in text.split(',') if item.strip())
+        if not pids <= self.s_token_pids:
+            raise ValueError("PID Filter entries must be IN, OUT or SETUP, got '" + text + "'")
+        return pids
+
+    def transaction_wanted(self, addr, endpoint, pid):
+        return (self.address_filter is None or addr in self.address_filter) and \
+            (self.endpoint_filter is None or endpoint in self.endpoint_filter) and \
+            (self.pid_filter is None or pid in self.pid_filter)
+
+    #--------------------------------------------------------------------------
+    # Instrumentation
+    #--------------------------------------------------------------------------
+    # Stands in for decode() when Instrumentation is on: times each call, counts the
+    # transactions it completes and closes the traffic windows.
+    def decode_instrumented(self, frame):
+        stats = self.stats
+        frames = None
+        if stats.window_start is None:
+            stats.window_start = frame.start_time
+        else:
+            elapsed = float(frame.start_time - stats.window_start)
+            if elapsed >= stats.window:
+                window_frame = self.stats_window_frame(stats.close_window(int(elapsed / stats.window) - 1))
+                if self.stats_frames:
+                    frames = [window_frame]
+                stats.window_start = frame.start_time
+        stats.window_end = frame.end_time
+        # an eop after the handshake completes the transaction, see decode()
+        ep_state = self.ep_state
+        completing = frame.type == 'eop' and ep_state is not None and ep_state.ack is not None and ep_state.wanted
+        if completing:
+            key = (ep_state.addr[0], ep_state.endpoint[0])
+            size = len(ep_state.data)
+            nak = ep_state.ack == "NAK"
+        start = time.perf_counter()
+        result = Hla.decode(self, frame)
+        stats.count_frame(frame.type, time.perf_counter() - start)
+        if completing:
+            stats.count_transaction(key, size, nak)
+        if frames is None:
+            return result
+        if isinstance(result, list):
+            frames.extend(result)
+        elif result is not None:
+            frames.append(result)
+        return frames
+
+    def stats_window_frame(self, window):
+        start_time, end_time, packets, size, naks, bytes_per_sec = window
+        return AnalyzerFrame('USB Stats', start_time, end_time,
+                             {'packets': packets, 'bytes': size, 'naks': naks, 'bytes_per_sec': bytes_per_sec})
+
+    # Final report of the instrumentation counters, on the report output (none with
+    # Periodic Frames and Report Output None, the windows are the frames then)
+    def report_stats(self):
+        self.stats_reported = True
+        if self.report_writer is None or self.report_writer.stream is None:
+            # no report output, or already closed
+            return
+        for record in self.stats.records():
+            self.report_writer.write('stats', *record)
+        for name, value in self.memory_usage().items():
+            self.report_writer.write('stats', 'memory', name, value, '', '', '')
+        for what, count in sorted(self.overflow_counts.items()):
+            self.report_writer.write('stats', 'overflow', what, count, '', '', '')
+        for frame_type, count in sorted(self.unknown_frame_types.items()):
+            self.report_writer.write('stats', 'unknown_frame', frame_type, count, '', '', '')
+        if self.render_cache is not None:
+            self.report_writer.write('stats', 'render_cache', 'hits', self.render_cache_hits, '', '', '')
+            self.report_writer.write('stats', 'render_cache', 'misses', self.render_cache_misses, '', '', '')
+        self.report_writer.flush()
+
+    # What the analyzer state holds on to: entry counts and buffered bytes
+    def memory_usage(self):
+        endpoint_bytes = 0
+        control_bytes = 0
+        for ep_state in self.endpoint_states.values():
+            endpoint_bytes += len(ep_state.data) + len(ep_state.last_data)
+            if ep_state.control is not None:
+                control_bytes += len(ep_state.control.data)
+        return {
+            'endpoint_states': len(self.endpoint_states),
+            'endpoint_bytes': endpoint_bytes,
+            'control_transfer_bytes': control_bytes,
+            'cid_mappings': len(self.map_CID_to_usage),
+            'sdp_parsers': len(self.sdp_parsers),
+            'sdp_buffer_bytes': sum(len(parser.buffer) for parser in self.sdp_parsers.values()),
+            'acl_reassemblers': len(self.acl_reassemblers),
+            'acl_buffer_bytes': sum(reassembler.buffered_bytes() for reassembler in self.acl_reassemblers.values()),
+            'devices': len(self.devices),
+            'endpoint_classes': len(self.endpoint_classes),
+            'unknown_frame_types': len(self.unknown_frame_types),
+            'report_pending': len(self.report_writer.pending) if self.report_writer is not None else 0,
+            'pcap_pending_bytes': len(self.pcap_writer.pending) if self.pcap_writer is not None else 0,
+            'index_pending': len(self.index_writer.pending) if self.index_writer is not None else 0,
+            'render_cache_entries': len(self.render_cache) if self.render_cache is not None else 0,
+        }
+
+    # Queue a free form text line on the report output, like print() does.
+    def report_debug(self, *args):
+        if self.report_writer is not None:
+            self.report_writer.write('debug', ' '.join(map(str, args)))
  
-    # returns, token Type, Size (bytes used), and value
-    def get_next_token(self, index, cb_left):
-        element = self.parse_data[index]
-        element_type = element >> 3
-        element_size = element & 7;
-
-        print("GNT: ", index, ",", cb_left, ", ", hex(element), "(", element_type, ",", element_size, ")" )
-        index += 1
-        try:
-            if (element == 0): # nil
-                element_size = 1
-                element_value = None
-            # type = 1 un signed
-            elif (element == 0x08): # unsigned one byte
-                element_size = 2
-                element_value = self.parse_data[index]
-            elif (element == 0x09): # unsigned 2  byte
-                element_size = 3
-                element_value = int.from_bytes(self.parse_data[index:index+2],'big', signed=False)
-            elif (element == 0x0A): # unsigned 4  byte
-                element_size = 5
-                element_value = int.from_bytes(self.parse_data[index:index+4],'big', signed=False)
-            elif (element == 0x0B): # unsigned 8  byte
-                element_size = 9
-                element_value = int.from_bytes(self.parse_data[index:index+8],'big', signed=False)
-            # type = 2 signed
-            elif (element == 0x10): # unsigned one byte
-                element_size = 2
-                element_value = int.from_bytes(self.parse_data[index:index+1],'big', signed=True)
-            elif (element == 0x11): # unsigned 2  byte
-                element_size = 3
-                element_value = int.from_bytes(self.parse_data[index:index+2],'big', signed=True)
-            elif (element == 0x12): # unsigned 4  byte
-                element_size = 5
-                element_value = int.from_bytes(self.parse_data[index:index+4],'big', signed=True)
-            elif (element == 0x13): # unsigned 8  byte
-                element_size = 9
-                element_value = int.from_bytes(self.parse_data[index:index+8],'big', signed=True)
-            # type = 3 uuid
-            elif (element == 0x18): # unsigned one byte
-                element_size = 2
-                element_value = self.parse_data[index] 
-            elif (element == 0x19): # unsigned 2  byte
-                element_size = 3
-                element_value = int.from_bytes(self.parse_data[index:index+2],'big', signed=False)
-            elif (element == 0x1A): # unsigned 4  byte
-                element_size = 5
-                element_value = int.from_bytes(self.parse_data[index:index+4],'big', signed=False)
-            # type = 4 String
-            elif (element == 0x25):
-                str_size = self.parse_data[index];
-                index += 1
-                element_size = str_size + 2
-                if (cb_left >= element_size):
-                    try:
-                        element_value = self.parse_data[index:index+str_size].decode('utf-8')
-                    except:
-                        element_value = "<str parse error>"
-                        count_out = 0
-                        for i in range(index, index+str_size):
-                            element_value += ' ' + hex(self.parse_data[i])
-                            count_out += 1
-                            if (count_out > 32):
-                                element_value += "..."
-                                break;
-
-            elif (element == 0x26):
-                str_size = (self.parse_data[index] << 8) + self.parse_data[index + 1] ;
-                index += 2
-                element_size = str_size + 3
-                if (cb_left >= element_size):
-                    try:
-                        element_value = self.parse_data[index:index+str_size].decode('utf-8')
-                    except:
-                        element_value = "<str parse error>"
-                        count_out = 0
-                        for i in range(index, index+str_size):
-                            element_value += ' ' + hex(self.parse_data[i])
-                            count_out += 1
-                            if (count_out > 64):
-                                element_value += "..."
-                                break;
-            # type = 5 Bool
-            elif (element == 0x28): # unsigned one byte
-                element_size = 2
-                element_value = self.parse_data[index] 
-
-            # type = 6 Data element sequence
-            elif (element == 0x35): 
-                sequence_size = str_size = self.parse_data[index]
-                element_size = 2
-                element_value = sequence_size
-            elif (element == 0x36):
-                sequence_size = (self.parse_data[index] << 8) + self.parse_data[index + 1] ;
-                element_size = 3
-                element_value = sequence_size
-            elif (element == 0x37):
-                sequence_size = int.from_bytes(self.parse_data[index:index+4],'big', signed=False) ;
-                element_size = 5
-                element_value = sequence_size
-            # type = 7 Data element sequence
-            elif (element == 0x3D): 
-                sequence_size = str_size = self.parse_data[index]
-                element_size = 2
-                element_value = sequence_size
-            elif (element == 0x3E):
-                sequence_size = (self.parse_data[index] << 8) + self.parse_data[index + 1] ;
-                element_size = 3
-                element_value = sequence_size
-            elif (element == 0x3F):
-                sequence_size = int.from_bytes(self.parse_data[index:index+4],'big', signed=False) ;
-                element_size = 5
-                element_value = sequence_size
-            else:
-                print("### DECODE Failed 0x", hex(element))
-                return element_type, 1, None
-        
-            # and return it.
-            if (cb_left < element_size):
-                print("<<<<<<<<<<<<<<<<<<<< split >>>>>>>>>>>>>>>>>>>>>>>>>>")
-                return -1, -1, None
-
-            return element_type, element_size, element_value
-        except:
-            # maybe not enough data left
-            print("<<<<<<<<<<<<<<<<<<<< Except >>>>>>>>>>>>>>>>>>>>>>>>>>")
-            return -1, -1, None
-
-
-    def decode_SDP_Attribute_results(self, frame: AnalyzerFrame, start_index):
-        print("DSDP:", end="")
-        for i in range(len(self.data_packet_save)):
-            if (i == start_index):
-                print("*", end='')
-            else:    
-                print(" ", end='')
-            print(hex(self.data_packet_save[i]), end="")
-        print("")
-        # example:
-        # (0)0x47 0x20 0x34 0x0 0x30 0x0 0x40 0x0 
-        # (8)0x7 0x0 0x0 0x0 0x2b 
-        # (12)0x0 0x26
-        # 0x36 0x3 0xad 0x36 0x0 0x8e 0x9 0x0 0x0 0xa 0x0 0x0 0x0 0x0 0x9 0x0 0x1 0x35 0x3 0x19 0x10 0x0 0x9 0x0 0x4 0x35 0xd 0x35 0x6 0x19 0x1 0x0 0x9 0x0 0x1 0x35 0x3 0x19 0x2 0x0 0x26
-        cb = (self.data_packet_save[start_index] << 8) + self.data_packet_save[start_index + 1]
-
-        # lets move the data to the parse_data 
+    # returns the data bytes as a display string, using the table chosen in __init__
+    def data_to_str(self, data):
+        return ''.join(map(self.byte_str_table.__getitem__, data))
+
+    # the data as shown in a frame: only the first max_display_bytes and the total
+    # length when there is more
+    def display_data_str(self, data):
+        if 0 < self.max_display_bytes < len(data):
+            return self.data_to_str(data[:self.max_display_bytes]) + ' ... (' + str(len(data)) + ' bytes)'
+        return self.data_to_str(data)
+
+    # Decode the attribute list bytes of an SDP_ServiceAttributeResponse (cmd 5)
+    # or SDP_ServiceSearchAttributeResponse (cmd 7).  The list may be split over
+    # several responses (continuation state not 0), the parser for the channel
+    # carries the partial elements over to the next one.
+    def decode_SDP_Attribute_results(self, packet, channel, cmd, start_index):
+        if len(packet) < start_index + 2:
+            return " (short)"
+        cb = (packet[start_index] << 8) + packet[start_index + 1]
         index = start_index + 2
-        if (self.parse_data == None):
-            self.parse_data = self.data_packet_save[index:index+cb]
-        else:
-            self.parse_data += self.data_packet_save[index:index+cb]
-            
-        print("Parse data:", end="")
-        for i in range(len(self.parse_data)):
-            print(" ", end='')
-            print(hex(self.parse_data[i]), end="")
-        print("")
-        cb = len(self.parse_data)
-        index = 0
-        # first pass print out in structure way...
-        while (cb > 0):
-            element_type, element_size, element_value = self.get_next_token(index, cb)
-            if (element_type == -1):
-                break;
-            print(";;;;", end="") # put in text area
-            for i in range(len(self.parse_level_bytes_left)):
-                #decrement the bytes left in each level
-                self.parse_level_bytes_left[i] -= element_size
-                print("  ", end="")
-
-            print("(", str(element_type), ",", str(element_size), ")", end='')
-            if (element_type in [6,7]): 
-                self.parse_level_bytes_left.append(element_value) # new collection level
-                print("{ (", element_value, ")", end='')
-                if (element_type == 6):
-                    self.parse_str += " {C"
-                else:
-                    self.parse_str += " {A"
-            else:
-                print(element_value, end='')
-                self.parse_str += " "
-                if  element_type in self.s_sdp_data_element_types:
-                    self.parse_str += self.s_sdp_data_element_types[element_type]
-                else:
-                    self.parse_str = '(0x' + hex(element_type ) + ')'
+        if len(packet) < index + cb:
+            return " (short)"
+        attribute_depth = 2 if cmd == 7 else 1
+        parser = self.sdp_parsers.get(channel)
+        if parser is None:
+            parser = SDPStreamParser(attribute_depth)
+            self.sdp_parsers[channel] = parser
+        elif parser.idle():
+            # the start of a new attribute list, the channel may carry both kinds of response
+            parser.attribute_depth = attribute_depth
+        with memoryview(packet) as view:
+            attributes = parser.feed(view[index:index + cb])
+        if parser.dropped:
+            self.note_overflow('SDP', parser.dropped)
+            parser.dropped = 0
 
-                if (element_type == 4):
-                    self.parse_str += element_value
-                elif self.base == 10:
-                    self.parse_str += str(element_value)
-                else:
-                    self.parse_str += hex(element_value)
-
-
-            # now see if any of the sequnce levels has completed
-            i = len(self.parse_level_bytes_left) - 1
-            output_parse_str = False
-            while (i >= 0):
-                if (self.parse_level_bytes_left[i] <= 0):
-                    self.parse_level_bytes_left.pop() # remove that item
-                    print(" }", end="")
-                    self.parse_str += " }"
-                    if (i <= 2):
-                        output_parse_str = True
-                i -= 1
-            cb -= element_size
-            index += element_size
-            print('') #output end of line    
-            if output_parse_str:
-                print("===== ", self.parse_str)
-                self.parse_str = "" 
-        
-        # see if we exited with cb > 0
-        if (cb <= 0):
-            self.parse_data = None
+        text_str = ''
+        for attribute_id, value in attributes:
+            attribute_str = " " + hex(attribute_id) + ":" + parser.element_to_str(value, self.base)
+            text_str += attribute_str
+            self.report_debug("=====", attribute_str)
+        if parser.error is not None:
+            self.report_debug("##### SDP", parser.error)
+            text_str += " (" + parser.error + ")"
+            parser.error = None
+        # a continuation state of 0 marks the last response, nothing may be left over
+        if (index + cb >= len(packet) or packet[index + cb] == 0) and not parser.idle():
+            self.report_debug("##### SDP incomplete attribute list, dropped")
+            text_str += " (incomplete)"
+            parser.reset()
+        return text_str
+
+    # returns the text for the 8 byte SETUP packet, one table lookup per request
+    def decode_setup_request(self, packet):
+        bmRequestType = packet[0]
+        bRequest = packet[1]
+        wValue = packet[2] + (packet[3] << 8)
+        wIndex = packet[4] + (packet[5] << 8)
+        wLength = packet[6] + (packet[7] << 8)
+        request = self.s_setup_requests.get((bmRequestType, bRequest))
+        if request is None:
+            text_str = "[RT:" + hex(bmRequestType) + " R:" + hex(bRequest) + ' V:' + hex(wValue)
         else:
-            del(self.parse_data[0:index])
-            print("<<<<<< Carry over  >>> :", end="") 
-            for i in range(len(self.parse_data)):
-                print(" ", end='')
-                print(hex(self.parse_data[i]), end="")
-            print("")
+            name, formatter = request
+            text_str = "[" + name
+            if formatter is not None:
+                text_str += formatter(self, wValue, wIndex)
+        return text_str + ' I:' + hex(wIndex) + " L:" + hex(wLength) + "]"
+
+    # Just the name of the request, without what leads on to the formatter's text, for the index
+    def setup_request_name(self, packet):
+        request = self.s_setup_requests.get((packet[0], packet[1]))
+        if request is None:
+            return "RT:" + hex(packet[0]) + " R:" + hex(packet[1])
+        return request[0].rstrip(' -:')
 
     def cid_name_to_str(self, cid):
         return_string = hex(cid)
@@ -344,357 +1802,758 @@ class Hla(HighLevelAnalyzer):
         return return_string
 
 
-    def parse_l2cap_commands(self, frame: AnalyzerFrame, cmd):
+    def parse_l2cap_commands(self, packet, cmd):
         # get the command name:
-        if cmd in self.s_l2cap_commands:
-            text_str = self.s_l2cap_commands[cmd]
-
-            # then see if we want to add additional information
-            if cmd == 0x02: # "L2CMD_CONNECTION_REQUEST" (8)0x2 0x3 0x4 0x0 0x1 0x0 0x40 0x0
-                try:
-                    PSM = self.data_packet_save[12] + (self.data_packet_save[13] << 8)
-                    SCID = self.data_packet_save[14] + (self.data_packet_save[15] << 8)
-                    text_str += " PSM: 0x" + hex(PSM)
-                    if PSM in self.s_psm_names:
-                        text_str += self.s_psm_names[PSM]
-                        self.map_CID_to_usage.update({SCID:{"PSM":PSM, "SORD":"S"}} )
-
-                    text_str += " SCID:" + hex(SCID) 
-                except:
-                    text_str += " (except)"
-
-            elif cmd == 0x03: #"L2CMD_CONNECTION_RESPONSE" (8)0x3 0x3 0x8 0x0 0x42 0x0 0x40 0x0 0x0 0x0 0x0 0x0
-                #try:
-                DCID = self.data_packet_save[12] + (self.data_packet_save[13] << 8)
-                SCID = self.data_packet_save[14] + (self.data_packet_save[15] << 8)
-                scid_map = self.map_CID_to_usage[SCID]
-                if scid_map != None:
-                    self.map_CID_to_usage.update({DCID:{"PSM":scid_map["PSM"], "SORD":"D"}} )
-                result = self.data_packet_save[16] + (self.data_packet_save[17] << 8)
-                status = self.data_packet_save[18] + (self.data_packet_save[19] << 8)
-                text_str += " SCID: " + self.cid_name_to_str(SCID) + " DCID: " + hex(DCID) + " RES: " + hex(result) + "Status: " + hex(status)
-                #except:
-                #   text_str += " (except)"
-            elif cmd == 0x04: #"L2CMD_CONFIG_REQUEST" 0x4 0x4 0x4 0x0 0x42 0x0 0x0 0x0  
-                try:
-                    DCID = self.data_packet_save[12] + (self.data_packet_save[13] << 8)
-                    flags = self.data_packet_save[14] + (self.data_packet_save[15] << 8)
-                    text_str += " DCID: " + self.cid_name_to_str(DCID) + " flags: " + hex(flags)
-                except:
-                    text_str += " (except)"
-            elif cmd == 0x05: # "L2CMD_CONFIG_RESPONSE", 0x5 0x2 0xa 0x0 0x42 0x0 0x0 0x0 0x0 0x0 0x1 0x2 0x30 0x0
-                try:
-                    len = self.data_packet_save[10] + (self.data_packet_save[11] << 8)
-                    SCID = self.data_packet_save[12] + (self.data_packet_save[13] << 8)
-                    flags = self.data_packet_save[14] + (self.data_packet_save[15] << 8)
-                    result = self.data_packet_save[16] + (self.data_packet_save[17] << 8)
-                    text_str += " SCID: " + self.cid_name_to_str(SCID) + " flags: " + hex(flags) + " RES: " + hex (result)
-                    if len > 8:
-                        config = self.data_packet_save[18] + (self.data_packet_save[19] << 8)
-                        text_str += "Config: " + hex(config)
-                except:
-                    text_str += " (except)"
-
-            elif cmd == 0x06: # "L2CMD_DISCONNECT_REQUEST",    
-                DCID = self.data_packet_save[12] + (self.data_packet_save[13] << 8)
-                SCID = self.data_packet_save[14] + (self.data_packet_save[15] << 8)
-                text_str += " DCID: " + self.cid_name_to_str(DCID) + " SCID: " + self.cid_name_to_str(SCID)
-
-            elif cmd == 0x07: # "L2CMD_DISCONNECT_RESPONSE",   
-                DCID = self.data_packet_save[12] + (self.data_packet_save[13] << 8)
-                SCID = self.data_packet_save[14] + (self.data_packet_save[15] << 8)
-                text_str += " DCID: " + self.cid_name_to_str(DCID) + " SCID: " + self.cid_name_to_str(SCID)
-            
-            elif cmd == 0x0A:  # "L2CMD_INFORMATION_REQUEST"
-                info_type = self.data_packet_save[12] + (self.data_packet_save[13] << 8)
-                text_str += " IT: " + hex(info_type)
-                if (info_type == 1):
-                    text_str += "(Connectionless MTU)"
-                elif (info_type == 2):
-                    text_str += "(Extended fetures supported)"
-                elif (info_type == 3):
-                    text_str += "(Fixed channels supported)"
-
-            elif cmd == 0x0B:  # "L2CMD_INFORMATION_RESPONSE"
-                #   0x47 0x20 0x10 0x0 0xc 0x0 0x1 0x0 (8)0xb 0x1 0x8 0x0 0x2 0x0 0x0 0x0 0x80 0x2 0x0 0x0
-                len = self.data_packet_save[10] + (self.data_packet_save[11] << 8)
-                info_type = self.data_packet_save[12] + (self.data_packet_save[13] << 8)
-                result = self.data_packet_save[14] + (self.data_packet_save[15] << 8)
-                text_str += " IT: " + hex(info_type) + " result: " + hex(result)
-                if (len > 4):
-                    text_str += " data:"
-                    for i in range(4, len): 
-                        text_str += " " + hex(self.data_packet_save[12+i])
+        if cmd not in self.s_l2cap_commands:
+            return ''.join([ '0x', hex(cmd ).upper()[2:] ])
+        text_str = self.s_l2cap_commands[cmd]
+
+        # then see if we want to add additional information
+        layout = self.s_l2cap_command_layouts[cmd]
+        if len(packet) < 12 + layout.size:
+            return text_str + " (short: " + str(len(packet)) + " bytes)"
+        _, _, length = self.s_l2cap_command_header.unpack_from(packet, 8)
+        fields = layout.unpack_from(packet, 12)
+
+        if cmd == 0x01: # "L2CMD_COMMAND_REJECT"
+            text_str += " reason: " + hex(fields[0])
+
+        elif cmd == 0x02: # "L2CMD_CONNECTION_REQUEST" (8)0x2 0x3 0x4 0x0 0x1 0x0 0x40 0x0
+            PSM, SCID = fields
+            text_str += " PSM: 0x" + hex(PSM)
+            if PSM in self.s_psm_names:
+                text_str += self.s_psm_names[PSM]
+                self.map_CID_to_usage.update({SCID:{"PSM":PSM, "SORD":"S"}} )
+            text_str += " SCID:" + hex(SCID)
+
+        elif cmd == 0x03: #"L2CMD_CONNECTION_RESPONSE" (8)0x3 0x3 0x8 0x0 0x42 0x0 0x40 0x0 0x0 0x0 0x0 0x0
+            DCID, SCID, result, status = fields
+            scid_map = self.map_CID_to_usage.get(SCID)
+            if scid_map != None:
+                self.map_CID_to_usage.update({DCID:{"PSM":scid_map["PSM"], "SORD":"D"}} )
+            text_str += " SCID: " + self.cid_name_to_str(SCID) + " DCID: " + hex(DCID) + " RES: " + hex(result) + "Status: " + hex(status)
+
+        elif cmd == 0x04: #"L2CMD_CONFIG_REQUEST" 0x4 0x4 0x4 0x0 0x42 0x0 0x0 0x0
+            DCID, flags = fields
+            text_str += " DCID: " + self.cid_name_to_str(DCID) + " flags: " + hex(flags)
+
+        elif cmd == 0x05: # "L2CMD_CONFIG_RESPONSE", 0x5 0x2 0xa 0x0 0x42 0x0 0x0 0x0 0x0 0x0 0x1 0x2 0x30 0x0
+            SCID, flags, result = fields
+            text_str += " SCID: " + self.cid_name_to_str(SCID) + " flags: " + hex(flags) + " RES: " + hex (result)
+            if length > 8 and len(packet) >= 20:
+                config = packet[18] + (packet[19] << 8)
+                text_str += "Config: " + hex(config)
+
+        elif cmd == 0x06 or cmd == 0x07: # "L2CMD_DISCONNECT_REQUEST" / "L2CMD_DISCONNECT_RESPONSE"
+            DCID, SCID = fields
+            text_str += " DCID: " + self.cid_name_to_str(DCID) + " SCID: " + self.cid_name_to_str(SCID)
+            if cmd == 0x07:
+                # the channel is closed, its CIDs may be given out again
+                for cid in (DCID, SCID):
+                    self.map_CID_to_usage.pop(cid, None)
+                    self.sdp_parsers.pop(cid, None)
+
+        elif cmd == 0x0A:  # "L2CMD_INFORMATION_REQUEST"
+            info_type = fields[0]
+            text_str += " IT: " + hex(info_type) + self.s_l2cap_info_types.get(info_type, '')
+
+        elif cmd == 0x0B:  # "L2CMD_INFORMATION_RESPONSE"
+            #   0x47 0x20 0x10 0x0 0xc 0x0 0x1 0x0 (8)0xb 0x1 0x8 0x0 0x2 0x0 0x0 0x0 0x80 0x2 0x0 0x0
+            info_type, result = fields
+            text_str += " IT: " + hex(info_type) + " result: " + hex(result)
+            if (length > 4):
+                text_str += " data:" + ''.join(map(self.s_byte_str_hex.__getitem__, packet[16:12 + length]))
+
+        return text_str
 
+    # Decode the ACL data on the HCI endpoint.  ACL packets and L2CAP frames split over
+    # several transactions are put back together first, and decoded once complete.
+    def decode_hci_acl(self, packet, pid=None, addr=None, endpoint=None):
+        key = (addr, endpoint, pid)
+        reassembler = self.acl_reassemblers.get(key)
+        if reassembler is None:
+            reassembler = ACLReassembler()
+            self.acl_reassemblers[key] = reassembler
+        frame = reassembler.add(packet)
+        if frame is None:
+            return self.acl_progress_text(reassembler.progress)
+        return self.decode_l2cap_frame(frame)
 
+    # Text of an HCI endpoint transaction the device did not take: what the reassembly is
+    # still waiting for, None when it waits for nothing
+    def hci_acl_pending(self, pid, addr, endpoint):
+        reassembler = self.acl_reassemblers.get((addr, endpoint, pid))
+        progress = reassembler.pending() if reassembler is not None else None
+        if progress is None:
+            return None
+        return self.acl_progress_text(progress)
+
+    def acl_progress_text(self, progress):
+        what, handle, length, needed = progress
+        if not needed:
+            return what + " " + hex(handle) + " (" + str(length) + " bytes)"
+        return what + " " + hex(handle) + " (" + str(length) + "/" + str(needed) + " bytes)"
+
+    # Simple decode of the L2CAP frame in an HCI ACL packet
+    def decode_l2cap_frame(self, packet):
+        if len(packet) <= 8:
+            return None
+        HCIHandle, HCILen, L2CAPHLen, Channel = self.s_hci_l2cap_header.unpack_from(packet)
+        cmd = packet[8]
+        # the index only takes the command code of signalling frames (CID 1, 5 on LE), on the other
+        # channels the byte is an SDP PDU ID or a HIDP header
+        self.l2cap_frame = (cmd if Channel == 1 or Channel == 5 else None, Channel)
+        cmd_type = cmd >> 4
+        if (cmd_type == 0):
+            if (Channel >= 0x40) and (Channel <= 0x4f):
+                if  cmd in self.s_sdp_commands:
+                    text_str = self.s_sdp_commands[cmd]
+                else:
+                    text_str = ''.join([ '0x', hex(cmd ).upper()[2:] ])
+                #lets play with decoding some
+                if cmd == 5 or cmd == 7:
+                    text_str += self.decode_SDP_Attribute_results(packet, Channel, cmd, 13)
+                #SDP s_sdp_commands
+            else:
+                # process l2cap commands
+                text_str = self.parse_l2cap_commands(packet, cmd)
         else:
-            try:
+            if  cmd_type in self.s_HIDP_msg_types:
+                text_str = self.s_HIDP_msg_types[cmd_type]
+            else:
                 text_str = ''.join([ '0x', hex(cmd ).upper()[2:] ])
-                text_str = self.parse_l2cap_connect_request(frame)
-            except:
-                text_str += " (except)"
-                
-
+            text_str += "(0x" + hex(cmd & 0xf )  + ")"
+        if HCILen + 4 != len(packet) or L2CAPHLen + 4 != HCILen:
+            text_str += " (HCI len: " + str(HCILen) + " L2CAP len: " + str(L2CAPHLen) + ")"
         return text_str
 
+    # The endpoint address (bEndpointAddress) a transaction is on: its number, with bit 7
+    # set for IN.  Endpoint 0 carries both directions of a control transfer, it stays 0.
+    @staticmethod
+    def endpoint_address(endpoint, pid):
+        return endpoint | 0x80 if pid == "IN" and endpoint != 0 else endpoint
+
+    # The class decoder for an endpoint address, a function returning the text for a
+    # transaction payload (or None), called with the payload, token PID, device address
+    # and endpoint number.  The HCI Channel setting, when set, overrides what the
+    # descriptors say, for both directions.
+    def endpoint_decoder(self, addr, address):
+        if address & 0x0F == self.HCIChannelFixed:
+            return self.decode_hci_acl
+        endpoint_class = self.endpoint_classes.get((addr, address))
+        if endpoint_class is None:
+            return None
+        if endpoint_class[3] == "hid":
+            # the compiled report descriptor of the interface, once it has been read
+            device = self.devices[addr]
+            report_descriptor = device.report_descriptors.get(device.endpoint_interfaces.get(address))
+            return report_descriptor.decode if report_descriptor is not None else None
+        return self.class_decoders.get(endpoint_class[3])
+
     def decode(self, frame: AnalyzerFrame):
-        #if frame.type == 'frame':
-        #    self.frame_start_time = frame.start_time
-        #    self.frame_data = {'pid':'', 'pid2':''}
-        if self.first_packet_start_time == None:
+        if self.first_packet_start_time is None:
             self.first_packet_start_time = frame.start_time
-        if frame.type == 'pid':
-            # test below ???
-            if self.frame_data != None:
-                pid_type = frame.data['value']
-                if pid_type == "IN":
-                    self.frame_data['pid'] = "IN" 
-                    self.frame_start_time = frame.start_time
-                elif pid_type == "OUT":
-                    self.frame_data['pid'] = "OUT" 
-                    self.frame_start_time = frame.start_time
-                elif pid_type == "SETUP":
-                    self.frame_data['pid'] = "SETUP" 
-                    self.frame_start_time = frame.start_time
-                if self.data_packet_save != None:
-                    if pid_type == "ACK":
-                        self.frame_ack_nak = "ACK"
-                    elif pid_type == "NAK":
-                        self.frame_ack_nak = "NAK"
-
-                #elif pid_type == "DATA0":
-                #    self.frame_data['pid2'] = "DATA0" 
-                #elif pid_type == "DATA1":
-                #    self.frame_data['pid2'] = "DATA1" 
-                #else:    
-                #    self.frame_data['pid'] = ''.join([ '0x', hex(pid_type[0]).upper()[2:] ]) 
-        elif frame.type ==  'addrendp':
-            self.addr = frame.data['value']
-            self.endpoint = frame.data['value2']
-        elif frame.type == 'data':
-            if self.data_packet_save == None:
-                self.data_packet_save = bytearray()
-            self.data_packet_save.extend(frame.data['data'])    
-            self.frame_end_time = frame.end_time
-        
-        elif frame.type == 'protocol':
-            self.data_packet_save = bytearray(8)
-            self.data_packet_save[0] = frame.data['bmRequestType'][0]
-            self.data_packet_save[1] = frame.data['bRequest'][0]
-
-            wValue = frame.data['wValue']
-            self.data_packet_save[2] = wValue[1]
-            self.data_packet_save[3] = wValue[0]
-
-            wIndex = frame.data['wIndex']   
-            self.data_packet_save[4] = wIndex[1]
-            self.data_packet_save[5] = wIndex[0]
-
-            wLength = frame.data['wLength']   
-            self.data_packet_save[6] = wLength[1]
-            self.data_packet_save[7] = wLength[0]
-            self.frame_end_time = frame.end_time
-        
-        elif frame.type == 'presult':
-            if not self.processing_report_data:
-                self.processing_report_data = True
-                start_bias_time = float(self.frame_start_time - self.first_packet_start_time)
-                print(str(start_bias_time), ';Result Report Start;', hex(self.endpoint[0]), ';', hex(self.addr[0]))
-
-            if self.data_packet_save == None:
-                self.data_packet_save = bytearray()
-            wLength = frame.data['wLength']   
-            data = frame.data['value']
-            if wLength[0] == 1:
-                self.data_packet_save.extend(data)
+            if self.report_writer is not None:
+                self.report_writer.time_origin = frame.start_time
+            if self.pcap_writer is not None:
+                self.pcap_writer.time_origin = frame.start_time
+            if self.index_writer is not None:
+                self.index_writer.time_origin = frame.start_time
+        handler = self.frame_handlers.get(frame.type)
+        if handler is None:
+            return self.decode_unknown(frame)
+        return handler(frame)
+
+    # Frame types this version does not know, counted per type and noted on the report once
+    def decode_unknown(self, frame):
+        count = self.unknown_frame_types.get(frame.type, 0)
+        if count == 0:
+            self.report_debug("##### unknown frame type", frame.type)
+        self.unknown_frame_types[frame.type] = count + 1
+        return None
+
+    def decode_pid(self, frame):
+        pid_type = frame.data['value']
+        kind = self.s_pid_kinds.get(pid_type)
+        if kind == "token":
+            self.token_pid = pid_type
+            self.token_start_time = frame.start_time
+            if self.sweeping:
+                if self.sweep_time is None:
+                    self.sweep_time = frame.start_time
+                elif float(frame.start_time - self.sweep_time) >= self.s_sweep_seconds:
+                    self.sweep_time = frame.start_time
+                    return self.sweep_held_frames(frame.start_time)
+        elif kind == "handshake" and self.ep_state is not None:
+            self.ep_state.ack = pid_type
+        return None
+
+    # The frames held back for too long, None if there are none.  Logic 2 never calls
+    # finish(), without this the last repeat or aggregate of an endpoint would never be shown.
+    # The output files also get their pending records once flush_seconds have passed, when
+    # the traffic left in the capture makes none.
+    def sweep_held_frames(self, now):
+        frames = None
+        if self.writers:
+            wall_time = time.monotonic()
+            for writer in self.writers:
+                if wall_time >= writer.next_flush_time:
+                    writer.flush()
+        for ep_state in self.endpoint_states.values():
+            if ep_state.repeats and float(now - ep_state.repeat_start_time) >= self.s_max_repeat_seconds:
+                if frames is None:
+                    frames = []
+                frames.append(self.repeat_frame(ep_state))
+            aggregate = ep_state.aggregate
+            if aggregate is not None and float(now - aggregate.end_time) >= self.s_bulk_idle_seconds:
+                if frames is None:
+                    frames = []
+                frames.append(self.bulk_frame(ep_state))
+        return frames
+
+    def decode_addrendp(self, frame):
+        addr = frame.data['value']
+        endpoint = frame.data['value2']
+        wanted = not self.filtering or self.transaction_wanted(addr[0], endpoint[0], self.token_pid)
+        key = (addr[0], endpoint[0])
+        ep_state = self.endpoint_states.get(key)
+        address = self.endpoint_address(endpoint[0], self.token_pid)
+        if ep_state is None:
+            ep_state = EndpointState(addr, endpoint)
+            self.configure_endpoint(ep_state, addr[0], address)
+            self.endpoint_states[key] = ep_state
+        elif ep_state.address != address:
+            # the other direction of the endpoint number, a separate endpoint for the descriptors
+            self.configure_endpoint(ep_state, addr[0], address)
+        if not wanted and endpoint[0] != 0 and ep_state.cacheable:
+            # filtered out and no state to follow (descriptors on endpoint 0, HCI): with no
+            # endpoint state the rest of the transaction is skipped
+            self.ep_state = None
+            return None
+        ep_state.start_transaction(self.token_pid, self.token_start_time, wanted)
+        self.ep_state = ep_state
+        return None
+
+    # The handlers below only run inside a transaction: data before the first
+    # token of the capture has nothing to tie it to.
+    def decode_data(self, frame):
+        ep_state = self.ep_state
+        if ep_state is None:
+            return None
+        ep_state.data.extend(frame.data['data'])
+        ep_state.has_data = True
+        ep_state.end_time = frame.end_time
+        return None
+
+    def decode_protocol(self, frame):
+        ep_state = self.ep_state
+        if ep_state is None:
+            return None
+        data = ep_state.data
+        data.clear()
+        data.append(frame.data['bmRequestType'][0])
+        data.append(frame.data['bRequest'][0])
+        # the 16 bit fields are reported most significant byte first, they are swapped
+        # byte by byte rather than through a reversed copy
+        value = frame.data['wValue']
+        data.append(value[1])
+        data.append(value[0])
+        value = frame.data['wIndex']
+        data.append(value[1])
+        data.append(value[0])
+        value = frame.data['wLength']
+        data.append(value[1])
+        data.append(value[0])
+        ep_state.has_data = True
+        ep_state.end_time = frame.end_time
+        return None
+
+    def decode_presult(self, frame):
+        ep_state = self.ep_state
+        if ep_state is None:
+            return None
+        if not ep_state.processing_report_data:
+            ep_state.processing_report_data = True
+            if self.report_writer is not None and ep_state.wanted:
+                self.report_writer.write('item', ep_state.start_time, 'Result Report Start', ep_state.endpoint[0], ep_state.addr[0], '')
+
+        wLength = frame.data['wLength']   
+        data = frame.data['value']
+        if wLength[0] == 1:
+            ep_state.data.extend(data)
+        else:
+            ep_state.data.append(data[1])
+            ep_state.data.append(data[0])
+        ep_state.has_data = True
+        if self.report_writer is not None and ep_state.wanted:
+            self.report_writer.write('item', frame.start_time, 'Item', ep_state.endpoint[0], ep_state.addr[0], frame.data['text'])
+        ep_state.end_time = frame.end_time
+        return None
+
+    # wchar and wLANGID frames
+    def decode_wchar(self, frame):
+        ep_state = self.ep_state
+        if ep_state is None:
+            return None
+        data = frame.data['data']
+        ep_state.data.append(data[1])
+        ep_state.data.append(data[0])
+        ep_state.has_data = True
+
+        text = frame.data['text']
+        if text != None:
+            if ep_state.text_size < self.s_max_text:
+                ep_state.text_parts.append(text)
+                ep_state.text_size += len(text)
             else:
-                data_rev = bytearray(2);
-                data_rev[0] = data[1]
-                data_rev[1] = data[0]
-                self.data_packet_save.extend(data_rev)
-            self.frame_end_time = frame.end_time
-
-            data = frame.data['value']
-            self.data_packet_save.extend(data)
-            start_bias_time = float(frame.start_time - self.first_packet_start_time)
-            print(str(start_bias_time), ';Item;', hex(self.endpoint[0]), ';', hex(self.addr[0]), ';', frame.data['text'])
-            self.frame_end_time = frame.end_time
-
-        elif (frame.type == 'wchar') or (frame.type == 'wLANGID'):
-            if self.data_packet_save == None:
-                self.data_packet_save = bytearray()
-            data = frame.data['data']
-            data_rev = bytearray(2);
-            data_rev[0] = data[1]
-            data_rev[1] = data[0]
-            self.data_packet_save.extend(data_rev)
-
-            text = frame.data['text']
-            if text != None:
-                if self.text_save == None:
-                    self.text_save = ''
-                self.text_save += text
-            self.frame_end_time = frame.end_time
-
-        elif frame.type == 'hiditem':
-            if not self.processing_report_data:
-                self.processing_report_data = True
-                start_bias_time = float(self.frame_start_time - self.first_packet_start_time)
-                print(str(start_bias_time), ';HID Report Start;', hex(self.endpoint[0]), ';', hex(self.addr[0]))
-
-            if self.data_packet_save == None:
-                self.data_packet_save = bytearray()
-            data = frame.data['value']
-            self.data_packet_save.extend(data)
-            start_bias_time = float(frame.start_time - self.first_packet_start_time)
-            print(str(start_bias_time), ';HID Item;', hex(self.endpoint[0]), ';', hex(self.addr[0]), ';', frame.data['text'])
-            self.frame_end_time = frame.end_time
-        elif frame.type == 'eop':
-            if (self.data_packet_save) != None and self.frame_ack_nak != None:
-                data_str = ''
-                text_str = ''
-                report_type = 'USB'
-                #print("PID", self.pid_type, "length: ", len(self.pid_type), "Hex:", hex(self.pid_type[0]))
-                if self.frame_data['pid'] == "SETUP":
-                    bmRequestType = self.data_packet_save[0]
-                    bmRequest = self.data_packet_save[1]
-                    wValue = self.data_packet_save[2] + (self.data_packet_save[3] << 8)
-                    wIndex = self.data_packet_save[4] + (self.data_packet_save[5] << 8)
-                    wLength = self.data_packet_save[6] + (self.data_packet_save[7] << 8)
-                    # first pass brute force
-                    if bmRequestType == 0x0:
-                        if bmRequest == 0x05:
-                            text_str = "SET_ADDRESS"
-                        elif bmRequest == 0x09:     
-                            text_str = "[SET_CONFIGURATION"
-                    elif bmRequestType == 0x21:
-                        if bmRequest == 0x0A:
-                            text_str = "[HID SET_IDLE"
-                        elif bmRequest == 0x09:     
-                            text_str = "[HID SET_REPORT"
-                    elif bmRequestType == 0x80:
-                        if bmRequest == 0x06:     
-                            text_str = "[GET_DESCRIPTOR -"
-                            # work off of high byte of wvalue
-                            if self.data_packet_save[3] == 0x01:
-                                text_str += " DEVICE #:" + str(self.data_packet_save[2]) 
-                            elif self.data_packet_save[3] == 0x02:
-                                text_str += " CONFIG #:" + str(self.data_packet_save[2])
-                            elif self.data_packet_save[3] == 0x03:
-                                text_str += " STRING #:" + str(self.data_packet_save[2])
-                            elif self.data_packet_save[3] == 0x06:
-                                text_str += " DEVICE_QUALIFIER #:" + str(self.data_packet_save[2])
-                            else:
-                                text_str += '<?? '
-                    elif bmRequestType == 0x81:
-                        if bmRequest == 0x06:     
-                            text_str = "[GET_DESCRIPTOR - HID REPORT"
-                    elif bmRequestType == 0xA1:
-                        if bmRequest == 0x01:     
-                            text_str = "[GET_REPORT -"
-                            # work off of high byte of wvalue
-                            if self.data_packet_save[3] == 0x03:
-                                text_str += " FEATURE # " + str(self.data_packet_save[2]) 
-                            else:
-                                text_str += '?? '
-                    elif bmRequestType == 0xa3 and bmRequest == 0:
-                        text_str = "[HUB Get Port:" + hex(wIndex) + " status"
-                    elif bmRequestType == 0x23:
-                        if bmRequest == 1:
-                            text_str = "[HUB Clear port:" + hex(wIndex) + " Feature:"
-                        elif bmRequest == 3:
-                            text_str = "[HUB Set port:" + hex(wIndex) + " Feature:"
-                        if wValue ==  0:
-                            text_str += " CONNECTION"
-                        if wValue ==  1:
-                            text_str += " ENABLE"
-                        if wValue ==  2:
-                            text_str += " SUSPEND"
-                        if wValue ==  3:
-                            text_str += " OVER_CURRENT"
-                        if wValue ==  4:
-                            text_str += " RESET"
-                        if wValue ==  8:
-                            text_str += " POWER"
-                        if wValue ==  9:
-                            text_str += " LOW_SPEED"
-                        if wValue ==  16:
-                            text_str += " C_CONNECTION"
-                        if wValue ==  17:
-                            text_str += " C_ENABLE"
-                        if wValue ==  18:
-                            text_str += " C_SUSPEND"
-                        if wValue ==  19:
-                            text_str += " C_OVER_CURRENT"
-                        if wValue ==  20:
-                            text_str += " C_RESET"
-                        if wValue ==  21:
-                            text_str += " TEST"
-                        if wValue ==  22:
-                            text_str += " INDICATOR"
-                    else:
-                        text_str = "[RT:" + hex(bmRequestType) + " R:" + hex(bmRequest) + ' V:' + hex(wValue)
-
-                    text_str +=' I:' + hex(wIndex) + " L:" + hex(wLength)  + "]"
-
-                    self.frame_data['text'] = text_str
-                    report_type = 'USB Text'
-                elif self.HCIChannelFixed == self.endpoint[0] and len(self.data_packet_save) > 8:
-                    # Try to do simple decode of L2CAP messages
-                    HCIHandle = self.data_packet_save[0] + (self.data_packet_save[1] << 8)
-                    HCILen = self.data_packet_save[2] + (self.data_packet_save[3] << 8)
-                    L2CAPHLen = self.data_packet_save[4] + (self.data_packet_save[5] << 8)
-                    Channel = self.data_packet_save[6] + (self.data_packet_save[7] << 8)
-                    cmd = self.data_packet_save[8]
-                    cmd_type = cmd >> 4
-                    if (cmd_type == 0):
-                        if (Channel >= 0x40) and (Channel <= 0x4f):
-                            if  cmd in self.s_sdp_commands:
-                                text_str = self.s_sdp_commands[cmd]
-                            else:
-                                text_str = ''.join([ '0x', hex(cmd ).upper()[2:] ])
-                            #lets play with decoding some
-                            if cmd == 7:
-                                self.decode_SDP_Attribute_results(frame, 13) 
-                            #SDP s_sdp_commands
-                        else:  
-                            # process l2cap commands
-                            text_str = self.parse_l2cap_commands(frame, cmd)
-                    else:
-                        if  cmd_type in self.s_HIDP_msg_types:
-                            text_str = self.s_HIDP_msg_types[cmd_type]
-                        else:
-                            text_str = ''.join([ '0x', hex(cmd ).upper()[2:] ])
-                        text_str += "(0x" + hex(cmd & 0xf )  + ")"
-                    self.frame_data['text'] = text_str
-
-  
-                elif self.text_save:
-                    text_str = self.text_save
-                    self.frame_data['text'] = text_str
-                    self.text_save = None
-                    report_type = 'USB Text'
-
-                for i in range(len(self.data_packet_save)):
-                    if self.base == 10:
-                        data_str +=' ' + str(self.data_packet_save[i])
-                    else:
-                        data_str +=' ' + hex(self.data_packet_save[i])
-                self.frame_data['data'] = data_str    
-                self.frame_data['endpoint'] = self.endpoint
-                self.frame_data['addr'] = self.addr
-                self.frame_data['ack'] = self.frame_ack_nak
-                self.data_packet_save = None
-                start_bias_time = float(self.frame_start_time - self.first_packet_start_time)
-                if self.base == 10:
-                    print(str(start_bias_time), ';', self.frame_data['pid'], ';', str(self.endpoint[0]), ';', str(self.addr[0]), ";", self.frame_data['ack'], ';', text_str, ";",data_str)
+                # no eop for a long time, do not let the text grow without end
+                self.note_overflow('text', len(text))
+        ep_state.end_time = frame.end_time
+        return None
+
+    def decode_hiditem(self, frame):
+        ep_state = self.ep_state
+        if ep_state is None:
+            return None
+        if not ep_state.processing_report_data:
+            ep_state.processing_report_data = True
+            if self.report_writer is not None and ep_state.wanted:
+                self.report_writer.write('item', ep_state.start_time, 'HID Report Start', ep_state.endpoint[0], ep_state.addr[0], '')
+
+        ep_state.data.extend(frame.data['value'])
+        ep_state.has_data = True
+        if self.report_writer is not None and ep_state.wanted:
+            self.report_writer.write('item', frame.start_time, 'HID Item', ep_state.endpoint[0], ep_state.addr[0], frame.data['text'])
+        ep_state.end_time = frame.end_time
+        return None
+
+    def decode_eop(self, frame):
+        ep_state = self.ep_state
+        if ep_state is not None and ep_state.ack != None:
+            self.ep_state = None
+            return self.complete_transaction(ep_state)
+        return None
+
+    # Called once the transaction got its handshake.  Returns the frames to show for it,
+    # None, one frame or a list of them.
+    def complete_transaction(self, ep_state):
+        frames = None
+        if ep_state.text_parts:
+            ep_state.text = ''.join(ep_state.text_parts)
+        # a transaction the filters leave out only updates the state (descriptors, L2CAP channels)
+        wanted = ep_state.wanted
+        if self.pcap_writer is not None and wanted:
+            # every transaction, whatever is shown of it
+            self.pcap_writer.write(ep_state.start_time, ep_state.pid, ep_state.addr[0], ep_state.endpoint[0],
+                                   ep_state.transfer_type, ep_state.ack, ep_state.data)
+        if not ep_state.cacheable:
+            if ep_state.ack == "ACK" or ep_state.ack == "NYET":
+                # the stateful decoder (ACL reassembly, L2CAP channels, SDP) is fed every transaction
+                # the device took, whatever is shown of it
+                ep_state.decoded = ep_state.decoder(ep_state.data, ep_state.pid, ep_state.addr[0], ep_state.endpoint[0])
+            else:
+                # NAKed or STALLed: the host sends the same bytes again
+                ep_state.decoded = self.hci_acl_pending(ep_state.pid, ep_state.addr[0], ep_state.endpoint[0])
+        shown = wanted and (ep_state.has_data or self.display_all)
+        if ep_state.endpoint[0] == 0:
+            transfer, in_transfer = self.track_control_transfer(ep_state)
+            if transfer is not None:
+                transfer_frame = self.control_transfer_complete(transfer)
+                if transfer_frame is not None:
+                    frames = [transfer_frame]
+            if in_transfer and self.show_transfers:
+                shown = False
+        elif self.aggregate_bulk and ep_state.transfer_type == 2 and ep_state.decoder is None:
+            # only plain bulk endpoints, the class decoders (HCI ACL, ...) need every packet
+            frames, aggregated = self.add_bulk_packet(ep_state)
+            if aggregated:
+                shown = False
+        if shown:
+            new_frame = self.transaction_frame(ep_state)
+            if frames is None:
+                frames = new_frame
+            elif isinstance(new_frame, list):
+                frames.extend(new_frame)
+            elif new_frame is not None:
+                frames.append(new_frame)
+        if self.overflows and not wanted:
+            # still counted in overflow_counts
+            self.overflows.clear()
+        elif self.overflows:
+            overflow_frames = self.overflow_frames(ep_state)
+            if frames is None:
+                frames = overflow_frames
+            elif isinstance(frames, list):
+                frames.extend(overflow_frames)
+            else:
+                frames = [frames] + overflow_frames
+        if self.index_writer is not None and wanted:
+            self.index_transaction(ep_state)
+        self.l2cap_frame = None
+        # the endpoint state is reused by its next transaction
+        ep_state.has_data = False
+        ep_state.ack = None
+        ep_state.text = None
+        ep_state.text_parts.clear()
+        ep_state.text_size = 0
+        ep_state.decoded = None
+        ep_state.processing_report_data = False
+        return frames
+
+    # Index row of the transaction: the request of a SETUP, and the L2CAP command and channel
+    # of the frame the HCI decoder completed with it
+    def index_transaction(self, ep_state):
+        packet = ep_state.data
+        request = None
+        if ep_state.pid == "SETUP" and len(packet) >= 8:
+            request = self.setup_request_name(packet)
+        l2cap_cmd = None
+        l2cap_cid = None
+        if self.l2cap_frame is not None:
+            l2cap_cmd, l2cap_cid = self.l2cap_frame
+        self.index_writer.write(ep_state.start_time, ep_state.addr[0], ep_state.endpoint[0], ep_state.pid, ep_state.ack,
+                                request, l2cap_cmd, l2cap_cid, bytes(packet))
+
+    # Follow the control transfer on endpoint 0 through its stages.  Returns the transfer
+    # when this transaction ended it (or a new SETUP cut it short), and whether the
+    # transaction was part of a transfer at all.
+    def track_control_transfer(self, ep_state):
+        transfer = ep_state.control
+        pid = ep_state.pid
+        ack = ep_state.ack
+        if pid == "SETUP":
+            if ack != "ACK":
+                return None, True
+            if transfer is not None:
+                transfer.status = "INCOMPLETE"
+            ep_state.control = ControlTransfer(ep_state)
+            return transfer, True
+        if transfer is None:
+            # no SETUP seen for it, for example the capture started in the middle
+            return None, False
+        if ack == "NAK":
+            return None, True
+        # NYET (high speed OUT): the data was taken, the device just has no room for more yet
+        if not transfer.status_stage and pid == transfer.data_pid():
+            transfer.end_time = ep_state.end_time
+            if ack == "STALL":
+                transfer.status = ack
+                ep_state.control = None
+                return transfer, True
+            packet = ep_state.data
+            transfer.data.extend(packet)
+            if ep_state.text:
+                transfer.text = ep_state.text if transfer.text is None else transfer.text + ep_state.text
+            size = len(packet)
+            if size > transfer.max_packet:
+                transfer.max_packet = size
+            if len(transfer.data) >= transfer.wLength or size < transfer.max_packet or size == 0:
+                transfer.status_stage = True
+            return None, True
+        if pid == transfer.status_pid():
+            # status stage, possibly early when the device had less data than asked for
+            transfer.end_time = ep_state.end_time
+            transfer.status = "ACK" if ack == "NYET" else ack
+            ep_state.control = None
+            return transfer, True
+        return None, False
+
+    # Sum the transaction up with the bulk packets before it.  Returns the frames of the
+    # aggregates it ended (a list or None) and whether it went into one.
+    def add_bulk_packet(self, ep_state):
+        frames = None
+        aggregate = ep_state.aggregate
+        if aggregate is not None and (aggregate.pid != ep_state.pid or ep_state.ack == "STALL"):
+            # direction change, or the endpoint gave up
+            frames = [self.bulk_frame(ep_state)]
+            aggregate = None
+        # NYET (high speed OUT): the data was taken, the device just has no room for more yet
+        if (ep_state.ack != "ACK" and ep_state.ack != "NYET") or (ep_state.pid != "IN" and ep_state.pid != "OUT"):
+            return frames, False
+        if aggregate is None:
+            aggregate = BulkAggregate(ep_state.pid, ep_state.start_time)
+            ep_state.aggregate = aggregate
+        packet = ep_state.data
+        size = len(packet)
+        aggregate.add(packet, ep_state.end_time, self.bulk_head_size)
+        if size < ep_state.max_packet or size == 0 or aggregate.packets >= self.s_bulk_max_packets:
+            # a short packet ends the transfer
+            if frames is None:
+                frames = []
+            frames.append(self.bulk_frame(ep_state))
+        return frames, True
+
+    def bulk_frame(self, ep_state):
+        aggregate = ep_state.aggregate
+        ep_state.aggregate = None
+        duration = float(aggregate.end_time - aggregate.start_time)
+        bytes_per_sec = aggregate.size / duration if duration > 0 else 0.0
+        crc_str = hex(aggregate.crc)
+        data_str = self.data_to_str(aggregate.head)
+        if aggregate.size > len(aggregate.head):
+            data_str += ' ... (' + str(aggregate.size) + ' bytes)'
+        frame_data = {'pid': aggregate.pid, 'endpoint': ep_state.endpoint, 'addr': ep_state.addr,
+                      'packets': aggregate.packets, 'bytes': aggregate.size, 'duration': duration,
+                      'bytes_per_sec': bytes_per_sec, 'crc32': crc_str, 'data': data_str}
+        if self.report_writer is not None:
+            self.report_writer.write('bulk', aggregate.start_time, aggregate.pid, ep_state.endpoint[0], ep_state.addr[0],
+                                     aggregate.packets, aggregate.size, duration, bytes_per_sec, crc_str, data_str)
+        return AnalyzerFrame('USB Bulk', aggregate.start_time, aggregate.end_time, frame_data)
+
+    # A buffer overflowed and dropped data, shown on the transaction it happened in
+    def note_overflow(self, what, dropped):
+        if self.overflows and self.overflows[-1][0] == what:
+            self.overflows[-1][1] += dropped
+            return
+        self.overflows.append([what, dropped])
+        self.overflow_counts[what] = self.overflow_counts.get(what, 0) + 1
+
+    def overflow_frames(self, ep_state):
+        frames = []
+        for what, dropped in self.overflows:
+            self.report_debug("#####", what, "overflow,", dropped, "dropped")
+            frames.append(AnalyzerFrame('USB Overflow', ep_state.start_time, ep_state.end_time,
+                                        {'what': what, 'dropped': dropped, 'endpoint': ep_state.endpoint,
+                                         'addr': ep_state.addr}))
+        self.overflows.clear()
+        return frames
+
+    # A control transfer is done.  Returns its frame when transfers are shown.
+    def control_transfer_complete(self, transfer):
+        if transfer.status == "ACK" and len(transfer.setup) == 8:
+            self.update_devices(transfer)
+        if not self.show_transfers or not transfer.wanted:
+            return None
+        text_str = self.decode_setup_request(transfer.setup)
+        if transfer.text:
+            text_str += ' "' + transfer.text + '"'
+        data_str = self.display_data_str(transfer.data)
+        frame_data = {'pid': 'CONTROL', 'text': text_str, 'data': data_str, 'endpoint': transfer.endpoint,
+                      'addr': transfer.addr, 'ack': transfer.status, 'length': len(transfer.data),
+                      'payload': bytes(transfer.data)}
+        if self.report_writer is not None:
+            if 0 < self.max_display_bytes < len(transfer.data):
+                data_str = self.data_to_str(transfer.data)
+            self.report_writer.write('packet', transfer.start_time, 'CONTROL', transfer.endpoint[0], transfer.addr[0],
+                                     transfer.status, text_str, data_str)
+        return AnalyzerFrame('USB Transfer', transfer.start_time, transfer.end_time, frame_data)
+
+    #--------------------------------------------------------------------------
+    # Descriptor cache
+    #--------------------------------------------------------------------------
+    # Keep the descriptors read by a completed control transfer, and forget the ones
+    # of devices that are given a new address or reset.
+    def update_devices(self, transfer):
+        setup = transfer.setup
+        request = (setup[0], setup[1])
+        addr = transfer.addr[0]
+        wValue = setup[2] + (setup[3] << 8)
+        data = transfer.data
+        if request == (0x80, 0x06):
+            descriptor_type = setup[3]
+            if descriptor_type == 1 and len(data) >= 18:
+                self.device_descriptors(addr).device = bytes(data[:18])
+            elif descriptor_type == 2 and len(data) >= 4 and len(data) >= data[2] + (data[3] << 8):
+                # only the complete configuration, not the first 9 byte read of it
+                device = self.device_descriptors(addr)
+                device.configuration = bytes(data)
+                self.index_configuration(device)
+        elif request == (0x81, 0x06) and setup[3] == 0x22:
+            # HID report descriptor of interface wIndex
+            self.add_report_descriptor(addr, setup[4], bytes(data))
+        elif request == (0x00, 0x05):
+            # SET_ADDRESS: the device at address 0 moves, whatever had the address is gone
+            self.forget_device(addr)
+            self.forget_device(wValue)
+            if self.reset_port is not None:
+                self.hub_ports[self.reset_port] = wValue
+                self.reset_port = None
+        elif request == (0x23, 0x03) and wValue == 4:
+            # hub SET_FEATURE PORT_RESET: the device on the port comes back at address 0
+            port = (addr, setup[4])
+            old_addr = self.hub_ports.pop(port, None)
+            if old_addr is not None:
+                self.forget_device(old_addr)
+            self.forget_device(0)
+            self.reset_port = port
+
+    def add_report_descriptor(self, addr, interface, descriptor):
+        report_descriptor = self.hid_report_descriptors.get(descriptor)
+        if report_descriptor is None:
+            report_descriptor = HIDReportDescriptor(descriptor)
+            if report_descriptor.error is not None:
+                self.report_debug("##### HID report descriptor", report_descriptor.error)
+            self.hid_report_descriptors[descriptor] = report_descriptor
+        self.device_descriptors(addr).report_descriptors[interface] = report_descriptor
+        self.update_endpoint_decoders(addr)
+
+    def device_descriptors(self, addr):
+        device = self.devices.get(addr)
+        if device is None:
+            device = DeviceDescriptors(addr)
+            self.devices[addr] = device
+        return device
+
+    def forget_device(self, addr):
+        device = self.devices.pop(addr, None)
+        if device is None:
+            return
+        for endpoint in device.endpoints:
+            del self.endpoint_classes[(addr, endpoint)]
+        self.update_endpoint_decoders(addr)
+
+    # Walk the interface and endpoint descriptors of the configuration
+    def index_configuration(self, device):
+        config = device.configuration
+        addr = device.addr
+        for endpoint in device.endpoints:
+            del self.endpoint_classes[(addr, endpoint)]
+        device.endpoints.clear()
+        device.endpoint_interfaces.clear()
+        interface = None
+        interface_number = None
+        index = 0
+        while index + 2 <= len(config):
+            bLength = config[index]
+            if bLength < 2 or index + bLength > len(config):
+                break
+            bDescriptorType = config[index + 1]
+            if bDescriptorType == 4 and bLength >= 9:
+                interface = (config[index + 5], config[index + 6], config[index + 7])
+                interface_number = config[index + 2]
+            elif bDescriptorType == 5 and bLength >= 7 and interface is not None:
+                # the direction is part of the address, 0x81 and 0x01 are different endpoints
+                endpoint = config[index + 2] & 0x8F
+                if interface == (0xE0, 0x01, 0x01):
+                    key = self.s_bluetooth_transfer_types.get(config[index + 3] & 0x03)
                 else:
-                    print(str(start_bias_time), ';', self.frame_data['pid'], ';', hex(self.endpoint[0]), ';', hex(self.addr[0]), ";", self.frame_data['ack'], ';', text_str, ";",data_str)
-                new_frame = AnalyzerFrame(report_type, self.frame_start_time, self.frame_end_time, self.frame_data)
-                #self.frame_data = {'pid':'', 'pid2':''}
-                self.frame_data = {'pid':''}
-                self.frame_ack_nak = None
-                self.processing_report_data = False
-                return new_frame
-
-        return None
\ No newline at end of file
+                    key = self.s_interface_classes.get(interface[0])
+                # the first (default) alternate setting wins
+                if endpoint not in device.endpoints:
+                    device.endpoint_interfaces[endpoint] = interface_number
+                    device.endpoints[endpoint] = interface + (key, config[index + 3] & 0x03,
+                                                              (config[index + 4] + (config[index + 5] << 8)) & 0x7FF)
+            index += bLength
+        for endpoint, endpoint_class in device.endpoints.items():
+            self.endpoint_classes[(addr, endpoint)] = endpoint_class
+        self.update_endpoint_decoders(addr)
+
+    def update_endpoint_decoders(self, addr):
+        for (state_addr, endpoint), ep_state in self.endpoint_states.items():
+            if state_addr == addr:
+                self.configure_endpoint(ep_state, addr, ep_state.address)
+
+    # Set what the descriptors say about the endpoint address on the state of its endpoint
+    # number, the state is configured again when the other direction is used
+    def configure_endpoint(self, ep_state, addr, address):
+        ep_state.address = address
+        ep_state.decoder = self.endpoint_decoder(addr, address)
+        # the HCI decoder keeps state (CIDs, SDP, reassembly), its text can not be reused
+        ep_state.cacheable = ep_state.decoder is None or isinstance(ep_state.decoder.__self__, HIDReportDescriptor)
+        endpoint_class = self.endpoint_classes.get((addr, address))
+        if endpoint_class is None:
+            ep_state.transfer_type = None
+            ep_state.max_packet = 0
+        else:
+            ep_state.transfer_type = endpoint_class[4]
+            ep_state.max_packet = endpoint_class[5]
+
+    # Build the frame (and report line) for the transaction, None while it is coalesced
+    def transaction_frame(self, ep_state):
+        packet = ep_state.data
+        coalesce = self.coalesce != 0 and (ep_state.ack == "NAK" or self.coalesce == 2)
+        if coalesce and ep_state.pid == ep_state.last_pid and ep_state.ack == ep_state.last_ack \
+                and packet == ep_state.last_data:
+            # same as the last one shown, only count it
+            if ep_state.repeats == 0:
+                ep_state.repeat_start_time = ep_state.start_time
+            ep_state.repeats += 1
+            ep_state.repeat_end_time = ep_state.end_time
+            if ep_state.repeats >= self.s_max_repeats:
+                return self.repeat_frame(ep_state)
+            return None
+        repeat_frame = None
+        if ep_state.repeats:
+            repeat_frame = self.repeat_frame(ep_state)
+        if coalesce:
+            ep_state.last_pid = ep_state.pid
+            ep_state.last_ack = ep_state.ack
+            ep_state.last_data[:] = packet
+        else:
+            ep_state.last_pid = None
+
+        render_cache = self.render_cache
+        if render_cache is not None and ep_state.cacheable and len(packet) <= self.s_render_cache_max_payload \
+                and ep_state.text is None:
+            cache_key = (ep_state.pid, ep_state.endpoint[0], bytes(packet), self.base, ep_state.decoder)
+            rendered = render_cache.get(cache_key)
+            if rendered is None:
+                self.render_cache_misses += 1
+                rendered = self.render_transaction(ep_state, packet)
+                render_cache[cache_key] = rendered
+                if len(render_cache) > self.render_cache_size:
+                    render_cache.popitem(last=False)
+            else:
+                self.render_cache_hits += 1
+                render_cache.move_to_end(cache_key)
+        else:
+            rendered = self.render_transaction(ep_state, packet)
+        report_type, text_str, data_str = rendered
+
+        frame_data = {'pid': ep_state.pid}
+        if text_str is not None:
+            frame_data['text'] = text_str
+        else:
+            text_str = ''
+        frame_data['data'] = data_str
+        frame_data['endpoint'] = ep_state.endpoint
+        frame_data['addr'] = ep_state.addr
+        frame_data['ack'] = ep_state.ack
+        if 0 < self.max_display_bytes < len(packet):
+            # all of it, as bytes, for whoever needs more than the frame shows
+            frame_data['length'] = len(packet)
+            frame_data['payload'] = bytes(packet)
+            if self.report_writer is not None:
+                data_str = self.data_to_str(packet)
+        if self.report_writer is not None:
+            self.report_writer.write('packet', ep_state.start_time, ep_state.pid, ep_state.endpoint[0], ep_state.addr[0],
+                                     ep_state.ack, text_str, data_str)
+        new_frame = AnalyzerFrame(report_type, ep_state.start_time, ep_state.end_time, frame_data)
+        if repeat_frame is not None:
+            return [repeat_frame, new_frame]
+        return new_frame
+
+    # Returns (frame type, text or None, data) for the transaction, the part of its frame
+    # that only depends on the payload (and on the endpoint's decoder).
+    def render_transaction(self, ep_state, packet):
+        if ep_state.pid == "SETUP":
+            return 'USB Text', self.decode_setup_request(packet), self.display_data_str(packet)
+        # class decoder for the endpoint (HCI ACL, ...), None when it has nothing to say
+        decoded = None
+        if not ep_state.cacheable:
+            decoded = ep_state.decoded
+        elif ep_state.decoder is not None:
+            decoded = ep_state.decoder(packet, ep_state.pid, ep_state.addr[0], ep_state.endpoint[0])
+        if decoded is not None:
+            return 'USB', decoded, self.display_data_str(packet)
+        if ep_state.text:
+            return 'USB Text', ep_state.text, self.display_data_str(packet)
+        return 'USB', None, self.display_data_str(packet)
+
+    # Summary frame for the transactions coalesced on the endpoint since the last one shown
+    def repeat_frame(self, ep_state):
+        duration = float(ep_state.repeat_end_time - ep_state.repeat_start_time)
+        data_str = self.display_data_str(ep_state.last_data)
+        frame_data = {'pid': ep_state.last_pid, 'endpoint': ep_state.endpoint, 'addr': ep_state.addr,
+                      'ack': ep_state.last_ack, 'count': ep_state.repeats, 'duration': duration, 'data': data_str}
+        if 0 < self.max_display_bytes < len(ep_state.last_data):
+            frame_data['length'] = len(ep_state.last_data)
+            frame_data['payload'] = bytes(ep_state.last_data)
+            if self.report_writer is not None:
+                data_str = self.data_to_str(ep_state.last_data)
+        if self.report_writer is not None:
+            self.report_writer.write('repeat', ep_state.repeat_start_time, ep_state.last_pid, ep_state.endpoint[0], ep_state.addr[0],
+                                     ep_state.last_ack, ep_state.repeats, duration, data_str)
+        new_frame = AnalyzerFrame('USB Repeat', ep_state.repeat_start_time, ep_state.repeat_end_time, frame_data)
+        ep_state.repeats = 0
+        return new_frame
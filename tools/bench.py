@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# Throughput benchmarks for Hla.decode() on synthetic USB traffic.
+#
+# For each scenario the frame stream is generated once, then decoded repeatedly
+# with a fresh analyzer.  Reports input frames/s, payload bytes/s and the peak
+# memory allocated while decoding.
+#
+# Absolute frames/s say little from one machine (or one load) to the next, so the
+# speed check compares against a reference version of HighLevelAnalyzer.py, by
+# default the committed one, decoded on the same machine in the same run with the
+# timed runs of the two interleaved.  The baseline file holds what does not depend
+# on the machine: the number of frames out and a CRC-32 of them, and the peak
+# memory.  Save it again when a change alters the output on purpose.
+#
+#   python tools/bench.py                      # run all scenarios
+#   python tools/bench.py --save-baseline      # store the output and memory in tools/bench_baseline.json
+#   python tools/bench.py --check              # fail on a slowdown against HEAD, or a baseline mismatch
+#   python tools/bench.py --check --reference v1.2
+
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import hla_runtime
+import usb_traffic
+from replay import frame_to_record, parse_settings, replay
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+EXTENSION_DIR = os.path.dirname(TOOLS_DIR)
+BASELINE_FILE = os.path.join(TOOLS_DIR, 'bench_baseline.json')
+
+
+# The workloads are sized for a few hundred ms per run, shorter runs are mostly noise
+def scenario_mouse_enumeration():
+    b = usb_traffic.FrameBuilder()
+    for _ in range(300):
+        usb_traffic.mouse_enumeration(b)
+    return b.frames, {}
+
+
+def scenario_hid_polling():
+    return usb_traffic.hid_polling(reports=3000, naks_per_report=9), {'DisplayLevel': 'All'}
+
+
+def scenario_bluetooth_hci():
+    return usb_traffic.bluetooth_hci(repeats=400, hid_reports=10000), {'HCIChannel': 2}
+
+
+def scenario_bulk_512():
+    return usb_traffic.bulk_stream(packets=10000, packet_size=512), {}
+
+
+def scenario_bulk_512_aggregate():
+    return usb_traffic.bulk_stream(packets=50000, packet_size=512, enumerate=True), {'BulkTransfers': 'Aggregate'}
+
+
+# name: function returning (frames, analyzer settings)
+SCENARIOS = {
+    'mouse_enumeration': scenario_mouse_enumeration,
+    'hid_polling_nak': scenario_hid_polling,
+    'bluetooth_hci': scenario_bluetooth_hci,
+    'bulk_512': scenario_bulk_512,
+    'bulk_512_aggregate': scenario_bulk_512_aggregate,
+}
+
+
+def load_reference_class(revision):
+    '''
+    Returns the Hla class of HighLevelAnalyzer.py as committed in revision.
+    '''
+    source = subprocess.check_output(['git', 'show', revision + ':HighLevelAnalyzer.py'], cwd=EXTENSION_DIR)
+    hla_runtime.install()
+    with tempfile.NamedTemporaryFile('wb', suffix='.py', delete=False) as f:
+        f.write(source)
+    try:
+        spec = importlib.util.spec_from_file_location('HighLevelAnalyzer_reference', f.name)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.unlink(f.name)
+    return module.Hla
+
+
+def decode_all(hla_class, settings, frames):
+    hla = hla_runtime.create_analyzer(hla_class, settings)
+    decode = hla.decode
+    for frame in frames:
+        decode(frame)
+    finish = getattr(hla, 'finish', None)
+    if finish is not None:
+        finish()
+
+
+def timed_decode(hla_class, settings, frames):
+    start = time.perf_counter()
+    decode_all(hla_class, settings, frames)
+    return time.perf_counter() - start
+
+
+def output_signature(hla_class, settings, frames):
+    '''
+    Returns (frames out, CRC-32 of them as JSON Lines).
+    '''
+    crc = [0]
+
+    def emit(new_frame):
+        line = json.dumps(frame_to_record(new_frame), sort_keys=True)
+        crc[0] = zlib.crc32(line.encode('utf-8'), crc[0])
+
+    hla = hla_runtime.create_analyzer(hla_class, settings)
+    return replay(hla, frames, emit)[1], crc[0]
+
+
+def run_scenario(hla_class, name, extra_settings, repeat, reference_class=None):
+    frames, settings = SCENARIOS[name]()
+    settings = dict({'ReportOutput': 'None', 'DisplayFormat': 'Hex'}, **settings)
+    settings.update(extra_settings)
+    data_bytes = usb_traffic.payload_bytes(frames)
+
+    # best of repeat runs, the reference runs interleaved so both see the same machine load
+    best = None
+    best_reference = None
+    for _ in range(repeat):
+        elapsed = timed_decode(hla_class, settings, frames)
+        best = elapsed if best is None else min(best, elapsed)
+        if reference_class is not None:
+            elapsed = timed_decode(reference_class, settings, frames)
+            best_reference = elapsed if best_reference is None else min(best_reference, elapsed)
+
+    tracemalloc.start()
+    decode_all(hla_class, settings, frames)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    frames_out, output_crc32 = output_signature(hla_class, settings, frames)
+    result = {
+        'frames': len(frames),
+        'frames_out': frames_out,
+        'output_crc32': output_crc32,
+        'seconds': best,
+        'frames_per_sec': len(frames) / best,
+        'bytes_per_sec': data_bytes / best,
+        'peak_memory_kb': peak / 1024.0,
+    }
+    if best_reference is not None:
+        result['speed_ratio'] = best_reference / best
+    return result
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns the list of regressions of results: slower than the reference run, or
+    not matching the baseline.
+    '''
+    failures = []
+    for name, result in results.items():
+        if result.get('speed_ratio', 1.0) < 1.0 - tolerance:
+            failures.append('%s: %.2fx the speed of the reference' % (name, result['speed_ratio']))
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['frames'] != base['frames']:
+            failures.append('%s: %d frames in, baseline %d, the scenario changed' % (name, result['frames'], base['frames']))
+        elif (result['frames_out'], result['output_crc32']) != (base['frames_out'], base['output_crc32']):
+            failures.append('%s: output changed (%d frames out, baseline %d), save the baseline again if intended'
+                            % (name, result['frames_out'], base['frames_out']))
+        if result['peak_memory_kb'] > base['peak_memory_kb'] * (1.0 + tolerance) + 64:
+            failures.append('%s: peak memory %.0f KB, baseline %.0f KB'
+                            % (name, result['peak_memory_kb'], base['peak_memory_kb']))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark Hla.decode() on synthetic USB traffic')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run (default all): ' + ', '.join(SCENARIOS))
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='timed runs per scenario, the best is kept')
+    parser.add_argument('-s', '--setting', action='append', metavar='NAME=VALUE', help='extra analyzer setting')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the output and memory as the new baseline')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with an error when slower than the reference or not matching the baseline')
+    parser.add_argument('--reference', metavar='REVISION',
+                        help='git revision of HighLevelAnalyzer.py to compare the speed with (default HEAD with --check)')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed regression, as a fraction (default 0.15)')
+    args = parser.parse_args(argv)
+
+    names = args.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            raise SystemExit('unknown scenario: ' + name)
+    extra_settings = parse_settings(args.setting)
+    hla_class = hla_runtime.load_hla_class()
+    reference = args.reference or ('HEAD' if args.check else None)
+    reference_class = load_reference_class(reference) if reference else None
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    print('%-20s %9s %12s %12s %10s %8s' % ('scenario', 'frames', 'frames/s', 'MB/s', 'peak KB', 'vs ref'))
+    for name in names:
+        result = run_scenario(hla_class, name, extra_settings, args.repeat, reference_class)
+        results[name] = result
+        ratio = '%.2fx' % result['speed_ratio'] if 'speed_ratio' in result else ''
+        print('%-20s %9d %12.0f %12.2f %10.0f %8s' % (name, result['frames'], result['frames_per_sec'],
+                                                    result['bytes_per_sec'] / 1e6, result['peak_memory_kb'], ratio))
+
+    if args.save_baseline:
+        for name, result in results.items():
+            baseline[name] = {key: result[key] for key in ('frames', 'frames_out', 'output_crc32', 'peak_memory_kb')}
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline saved to', args.baseline)
+
+    if args.check:
+        failures = compare(results, baseline, args.tolerance)
+        for failure in failures:
+            print('REGRESSION', failure)
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+# Stand-in for the parts of the Logic 2 "saleae.analyzers" module the HLA uses.
+#
+# Logic 2 supplies saleae.analyzers to extensions at run time, it is not something
+# that can be pip installed.  This module provides just enough of it to construct
+# the Hla class and drive its decode() function from a script, for example to replay
+# a recorded stream of low level frames or to profile the analyzer.
+
+import os
+import sys
+import types
+
+
+class AnalyzerFrame:
+    '''
+    A frame as passed to and returned by decode().  The times are plain float
+    seconds here instead of Logic 2 GraphTime values, the HLA only ever
+    subtracts them and converts the difference to float.
+    '''
+    __slots__ = ('type', 'start_time', 'end_time', 'data')
+
+    def __init__(self, type, start_time, end_time, data=None):
+        self.type = type
+        self.start_time = start_time
+        self.end_time = end_time
+        self.data = data if data is not None else {}
+
+    def __repr__(self):
+        return 'AnalyzerFrame(%r, %r, %r, %r)' % (self.type, self.start_time, self.end_time, self.data)
+
+
+class HighLevelAnalyzer:
+    pass
+
+
+class Setting:
+    default = None
+
+    def __init__(self, label='', **kwargs):
+        self.label = label
+
+    def convert(self, value):
+        return value
+
+
+class StringSetting(Setting):
+    default = ''
+
+
+class NumberSetting(Setting):
+    def __init__(self, label='', min_value=None, max_value=None, **kwargs):
+        super().__init__(label)
+        self.min_value = min_value
+        self.max_value = max_value
+        self.default = min_value if min_value is not None else 0.0
+
+    def convert(self, value):
+        value = float(value)
+        if (self.min_value is not None and value < self.min_value) or \
+           (self.max_value is not None and value > self.max_value):
+            raise ValueError('%s: %s out of range [%s, %s]' % (self.label, value, self.min_value, self.max_value))
+        return value
+
+
+class ChoicesSetting(Setting):
+    def __init__(self, choices, label='', **kwargs):
+        super().__init__(label)
+        self.choices = tuple(choices)
+        self.default = self.choices[0]
+
+    def convert(self, value):
+        if value not in self.choices:
+            raise ValueError('%s: %r is not one of %r' % (self.label, value, self.choices))
+        return value
+
+
+def install():
+    '''
+    Make "import saleae.analyzers" work.  The real module is used when it can be
+    imported, otherwise this module is registered in its place.
+    '''
+    try:
+        import saleae.analyzers
+        return sys.modules['saleae.analyzers']
+    except ImportError:
+        pass
+    package = types.ModuleType('saleae')
+    package.__path__ = []
+    package.analyzers = sys.modules[__name__]
+    sys.modules['saleae'] = package
+    sys.modules['saleae.analyzers'] = sys.modules[__name__]
+    return sys.modules[__name__]
+
+
+def load_hla_class():
+    '''
+    Import HighLevelAnalyzer.py from the extension directory (the parent of this
+    tools directory) and return its Hla class.
+    '''
+    install()
+    extension_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if extension_dir not in sys.path:
+        sys.path.insert(0, extension_dir)
+    import HighLevelAnalyzer
+    return HighLevelAnalyzer.Hla
+
+
+def settings_of(hla_class):
+    '''
+    Returns {attribute name: setting} for the settings declared on the class.
+    '''
+    settings = {}
+    for klass in reversed(hla_class.__mro__):
+        for name, value in vars(klass).items():
+            if isinstance(value, Setting) or type(value).__name__.endswith('Setting'):
+                settings[name] = value
+    return settings
+
+
+def create_analyzer(hla_class, settings=None):
+    '''
+    Construct the analyzer the way Logic 2 does: the setting values are stored on
+    the instance before __init__ runs.  Settings not given use their default.
+    '''
+    settings = dict(settings or {})
+    hla = hla_class.__new__(hla_class)
+    for name, setting in settings_of(hla_class).items():
+        if name in settings:
+            value = settings.pop(name)
+            if isinstance(setting, Setting):
+                value = setting.convert(value)
+        else:
+            value = getattr(setting, 'default', None)
+        setattr(hla, name, value)
+    if settings:
+        raise ValueError('Unknown settings: ' + ', '.join(sorted(settings)))
+    hla.__init__()
+    return hla
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# Decode a large recorded frame stream on several processes.
+#
+# The capture is cut into parts at safe transaction boundaries (Hla.at_safe_boundary()),
+# each part is decoded by its own analyzer in a process pool, and the frames are written
+# out in start time order.  What a part needs to know from the frames before it - device
+# descriptors and addresses, L2CAP channels - comes from a pre-pass: one analyzer that is
+# only given the transactions on endpoint 0 and on HCI endpoints, and exports its state
+# (Hla.export_state()) at every place the capture is cut.  The capture is never held in
+# memory: the pre-pass reads it through once and notes the byte offset of each cut, and
+# each worker reads its own part from the file.
+#
+# The output is the frames tools/replay.py emits, sorted by start time.  Repeats and bulk
+# aggregates still open at the end of a part are closed there, so with Coalesce Repeats or
+# Bulk Transfers on they may come out in more pieces than with replay.py.
+#
+# Example:
+#   python tools/parallel_decode.py capture.bin -o frames.jsonl -j 8 -s HCIChannel=2
+
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import hla_runtime
+from replay import frame_to_record, parse_settings, read_frames_at
+
+# settings naming an output file, each part would write over the others
+FILE_SETTINGS = ('ReportFile', 'PcapFile', 'IndexFile')
+
+
+#--------------------------------------------------------------------------
+# Pre-pass
+#--------------------------------------------------------------------------
+def find_parts(hla_class, settings, path, part_frames):
+    '''
+    Returns ([(byte offset of the first frame, pickled analyzer state)] of the parts,
+    frames in the capture).  The first part starts at the first frame with no state.
+
+    The pre-pass analyzer is only handed the transactions that change the state
+    carried from part to part, the others are skipped here without a decode() call.
+    '''
+    hla = hla_runtime.create_analyzer(hla_class, dict(settings, Instrumentation='Off'))
+    decode = hla.decode
+    pid_kinds = hla.s_pid_kinds
+    parts = [(None, None)]
+    next_cut = part_frames
+    token = None
+    wanted = False
+    index = 0
+    for offset, frame in read_frames_at(path):
+        index += 1
+        frame_type = frame.type
+        if frame_type == 'pid' and pid_kinds.get(frame.data['value']) == "token":
+            # parts start with the token of a transaction, an eop may also be the end of just the token packet
+            if index >= next_cut and hla.at_safe_boundary():
+                parts.append((offset, pickle.dumps(hla.export_state(), pickle.HIGHEST_PROTOCOL)))
+                next_cut = index + part_frames
+            token = frame
+            wanted = False
+        elif frame_type == 'addrendp':
+            addr = frame.data['value'][0]
+            endpoint = frame.data['value2'][0]
+            # the analyzer follows these whatever the filters of the settings leave out
+            wanted = token is not None and (endpoint == 0 or hla.endpoint_decoder(
+                addr, hla.endpoint_address(endpoint, token.data['value'])) == hla.decode_hci_acl)
+            if wanted:
+                decode(token)
+                decode(frame)
+        elif wanted:
+            decode(frame)
+    return parts, index
+
+
+#--------------------------------------------------------------------------
+# Parts
+#--------------------------------------------------------------------------
+worker_hla_class = None
+
+
+def init_worker():
+    global worker_hla_class
+    worker_hla_class = hla_runtime.load_hla_class()
+
+
+def decode_part(job):
+    '''
+    Decode the frames of one part, read from the capture between the byte offsets
+    start and end, returns its output as records sorted by start time.
+    '''
+    path, settings, state, start, end = job
+    hla = hla_runtime.create_analyzer(worker_hla_class, settings)
+    if state is not None:
+        hla.import_state(pickle.loads(state))
+    decode = hla.decode
+    AnalyzerFrame = hla_runtime.AnalyzerFrame
+    out = []
+    for _, frame in read_frames_at(path, start, end):
+        result = decode(frame)
+        if result is None:
+            continue
+        if isinstance(result, AnalyzerFrame):
+            out.append(result)
+        else:
+            out.extend(result)
+    out.extend(hla.finish())
+    out.sort(key=lambda new_frame: new_frame.start_time)
+    return [frame_to_record(new_frame) for new_frame in out]
+
+
+def parallel_decode(path, settings, jobs=None, part_frames=200000):
+    '''
+    Returns (frames in the capture at path, iterator over the records of the frames
+    decoded from it, in start time order).  The output of a part only has frames that
+    start within it, so the parts are merged by putting them one after the other.
+    '''
+    for name in FILE_SETTINGS:
+        if settings.get(name):
+            raise ValueError(name + ' is not supported when decoding in parallel, use tools/replay.py')
+    settings = dict(settings, ReportOutput='None')
+    parts, count = find_parts(hla_runtime.load_hla_class(), settings, path, part_frames)
+    return count, decode_parts(path, settings, parts, jobs)
+
+
+def decode_parts(path, settings, parts, jobs):
+    ends = [start for start, _ in parts[1:]] + [None]
+    work = ((path, settings, state, start, end) for (start, state), end in zip(parts, ends))
+    with multiprocessing.Pool(jobs, initializer=init_worker) as pool:
+        for records in pool.imap(decode_part, work):
+            yield from records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Decode recorded low level USB frames on several processes')
+    parser.add_argument('capture', help='JSON Lines or binary frame capture')
+    parser.add_argument('-o', '--output', default='-',
+                        help="file for the emitted frames as JSON Lines, '-' for stdout (default), 'none' to discard")
+    parser.add_argument('-s', '--setting', action='append', metavar='NAME=VALUE',
+                        help='analyzer setting, for example DisplayFormat=Hex (may be repeated)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--part-frames', type=int, default=200000,
+                        help='frames per part, parts end at the next safe boundary after that (default 200000)')
+    args = parser.parse_args(argv)
+
+    settings = parse_settings(args.setting)
+    start = time.perf_counter()
+    try:
+        count_in, records = parallel_decode(args.capture, settings, args.jobs, args.part_frames)
+    except ValueError as error:
+        raise SystemExit(str(error))
+
+    out = None
+    if args.output == '-':
+        out = sys.stdout
+    elif args.output.lower() != 'none':
+        out = open(args.output, 'w', encoding='utf-8')
+    count_out = 0
+    try:
+        for record in records:
+            count_out += 1
+            if out is not None:
+                out.write(json.dumps(record))
+                out.write('\n')
+    finally:
+        if out is not None and out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - start
+    print('%d frames in, %d frames out, %.3f s (%.0f frames/s)'
+          % (count_in, count_out, elapsed, count_in / elapsed if elapsed else 0.0), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
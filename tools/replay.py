@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# Replay a recorded stream of low level USB analyzer frames through the HLA.
+#
+# The input is the sequence of frames the usb-analyzer hands to decode()
+# (pid, addrendp, data, protocol, wchar, wLANGID, hiditem, presult, eop), stored
+# either as JSON Lines or in the binary format written by write_capture().  The
+# frames decode() returns are written out as JSON Lines.
+#
+# JSON Lines records look like:
+#   {"type": "data", "start_time": 1.25, "end_time": 1.26, "data": {"data": [18, 1, 0, 2]}}
+# Byte values (data, value, value2, bmRequestType, ...) are stored as lists of ints.
+#
+# Example:
+#   python tools/replay.py capture.jsonl -o frames.jsonl -s DisplayFormat=Hex -s HCIChannel=2
+
+import argparse
+import json
+import marshal
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import hla_runtime
+from hla_runtime import AnalyzerFrame
+
+BINARY_MAGIC = b'HLAFRAMES1\n'
+
+
+#--------------------------------------------------------------------------
+# Frame (de)serialization
+#--------------------------------------------------------------------------
+def value_to_json(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return list(value)
+    if isinstance(value, dict):
+        return {k: value_to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [value_to_json(v) for v in value]
+    return value
+
+
+def frame_to_record(frame):
+    return {'type': frame.type, 'start_time': float(frame.start_time), 'end_time': float(frame.end_time),
+            'data': value_to_json(frame.data)}
+
+
+def record_to_frame(record):
+    data = {}
+    for key, value in record.get('data', {}).items():
+        if isinstance(value, list):
+            value = bytes(value)
+        data[key] = value
+    return AnalyzerFrame(record['type'], record['start_time'], record['end_time'], data)
+
+
+def read_frames(path):
+    '''
+    Generator returning the frames stored in path, a JSON Lines or binary capture.
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+            while True:
+                try:
+                    frame_type, start_time, end_time, data = marshal.load(f)
+                except EOFError:
+                    return
+                yield AnalyzerFrame(frame_type, start_time, end_time, data)
+        f.seek(0)
+        for line in f:
+            line = line.strip()
+            if line:
+                yield record_to_frame(json.loads(line))
+
+
+def read_frames_at(path, start=None, end=None):
+    '''
+    Generator returning (byte offset, frame) for the frames stored in path, from the
+    frame at offset start (default the first) up to the one at offset end (default
+    to the end of the file).  Offsets are those returned by an earlier read.  Slower
+    than read_frames(), for the tools that cut a capture into parts.
+    '''
+    with open(path, 'rb') as f:
+        binary = f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+        offset = f.tell() if binary else 0
+        if start is not None:
+            offset = start
+        f.seek(offset)
+        if binary:
+            tell = f.tell
+            while offset != end:
+                try:
+                    frame_type, start_time, end_time, data = marshal.load(f)
+                except EOFError:
+                    return
+                yield offset, AnalyzerFrame(frame_type, start_time, end_time, data)
+                offset = tell()
+            return
+        for line in f:
+            if offset == end:
+                return
+            line_offset = offset
+            offset += len(line)
+            line = line.strip()
+            if line:
+                yield line_offset, record_to_frame(json.loads(line))
+
+
+def write_capture(path, frames, binary=False):
+    '''
+    Store frames in path.  The binary format is a magic line followed by one
+    marshal record per frame, it loads several times faster than JSON.
+    '''
+    with open(path, 'wb') as f:
+        if binary:
+            f.write(BINARY_MAGIC)
+            for frame in frames:
+                marshal.dump((frame.type, float(frame.start_time), float(frame.end_time),
+                              {k: bytes(v) if isinstance(v, (bytearray, memoryview)) else v
+                               for k, v in frame.data.items()}), f)
+        else:
+            for frame in frames:
+                f.write(json.dumps(frame_to_record(frame)).encode('utf-8'))
+                f.write(b'\n')
+
+
+#--------------------------------------------------------------------------
+# Replay
+#--------------------------------------------------------------------------
+def replay(hla, frames, emit=None):
+    '''
+    Feed frames through hla.decode() as fast as possible.  Every frame returned
+    is passed to emit (when given).  Returns (frames in, frames out).
+    '''
+    decode = hla.decode
+    count_in = 0
+    count_out = 0
+    for frame in frames:
+        count_in += 1
+        result = decode(frame)
+        if result is None:
+            continue
+        if isinstance(result, AnalyzerFrame):
+            result = (result,)
+        for new_frame in result:
+            count_out += 1
+            if emit is not None:
+                emit(new_frame)
+    finish = getattr(hla, 'finish', None)
+    if finish is not None:
+        for new_frame in finish() or ():
+            count_out += 1
+            if emit is not None:
+                emit(new_frame)
+    return count_in, count_out
+
+
+def parse_settings(items):
+    settings = {}
+    for item in items or ():
+        name, sep, value = item.partition('=')
+        if not sep:
+            raise SystemExit('settings are given as Name=Value, got: ' + item)
+        settings[name] = value
+    return settings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded low level USB frames through the HLA')
+    parser.add_argument('capture', help='JSON Lines or binary frame capture')
+    parser.add_argument('-o', '--output', default='-',
+                        help="file for the emitted frames as JSON Lines, '-' for stdout (default), 'none' to discard")
+    parser.add_argument('-s', '--setting', action='append', metavar='NAME=VALUE',
+                        help='analyzer setting, for example DisplayFormat=Hex (may be repeated)')
+    parser.add_argument('--to-binary', metavar='FILE',
+                        help='only convert the capture to the binary format and exit')
+    args = parser.parse_args(argv)
+
+    if args.to_binary:
+        write_capture(args.to_binary, read_frames(args.capture), binary=True)
+        return 0
+
+    settings = parse_settings(args.setting)
+    settings.setdefault('ReportOutput', 'None')
+    hla = hla_runtime.create_analyzer(hla_runtime.load_hla_class(), settings)
+
+    out = None
+    emit = None
+    if args.output == '-':
+        out = sys.stdout
+    elif args.output.lower() != 'none':
+        out = open(args.output, 'w', encoding='utf-8')
+    if out is not None:
+        def emit(frame):
+            out.write(json.dumps(frame_to_record(frame)))
+            out.write('\n')
+
+    start = time.perf_counter()
+    count_in, count_out = replay(hla, read_frames(args.capture), emit)
+    elapsed = time.perf_counter() - start
+    if out is not None and out is not sys.stdout:
+        out.close()
+    print('%d frames in, %d frames out, %.3f s (%.0f frames/s)'
+          % (count_in, count_out, elapsed, count_in / elapsed if elapsed else 0.0), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
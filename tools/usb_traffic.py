@@ -0,0 +1,325 @@
+# Synthetic low level USB frame streams, in the form the usb-analyzer hands them to
+# the HLA's decode().  Used by the benchmarks and handy for trying out the HLA offline.
+#
+# Each generator returns a list of AnalyzerFrame objects with increasing times.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from hla_runtime import AnalyzerFrame
+
+# Approximate full speed timings, in seconds
+PACKET_GAP = 0.5e-6
+BYTE_TIME = 0.67e-6
+FRAME_TIME = 1e-3
+
+
+class FrameBuilder:
+    '''
+    Builds the frame sequence for whole USB transactions.  Every packet is
+    followed by its own eop frame, the same way the usb-analyzer reports them.
+    '''
+    def __init__(self, start_time=0.0):
+        self.time = start_time
+        self.frames = []
+
+    def add(self, frame_type, size=3, **data):
+        end_time = self.time + size * BYTE_TIME
+        self.frames.append(AnalyzerFrame(frame_type, self.time, end_time, data))
+        self.time = end_time
+
+    def eop(self):
+        self.add('eop', 1)
+        self.time += PACKET_GAP
+
+    def pid(self, pid):
+        self.add('pid', 1, value=pid)
+
+    def token(self, pid, addr, endpoint):
+        self.pid(pid)
+        self.add('addrendp', 2, value=bytes([addr]), value2=bytes([endpoint]))
+        self.eop()
+
+    def handshake(self, pid):
+        self.pid(pid)
+        self.eop()
+
+    def data_packet(self, data, data_pid='DATA1'):
+        self.pid(data_pid)
+        if data:
+            self.add('data', len(data), data=bytes(data))
+        self.eop()
+
+    def setup(self, addr, bmRequestType, bRequest, wValue, wIndex, wLength):
+        self.token('SETUP', addr, 0)
+        self.pid('DATA0')
+        # The usb-analyzer reports the 16 bit fields most significant byte first
+        self.add('protocol', 8, bmRequestType=bytes([bmRequestType]), bRequest=bytes([bRequest]),
+                 wValue=wValue.to_bytes(2, 'big'), wIndex=wIndex.to_bytes(2, 'big'),
+                 wLength=wLength.to_bytes(2, 'big'))
+        self.eop()
+        self.handshake('ACK')
+
+    def data_in(self, addr, endpoint, data, handshake='ACK', data_pid='DATA1'):
+        self.token('IN', addr, endpoint)
+        if handshake == 'NAK':
+            self.handshake('NAK')
+            return
+        self.data_packet(data, data_pid)
+        self.handshake(handshake)
+
+    def data_out(self, addr, endpoint, data, handshake='ACK', data_pid='DATA0'):
+        self.token('OUT', addr, endpoint)
+        self.data_packet(data, data_pid)
+        self.handshake(handshake)
+
+    def control_in(self, addr, bmRequestType, bRequest, wValue, wIndex, data, max_packet=8):
+        self.setup(addr, bmRequestType, bRequest, wValue, wIndex, len(data))
+        data_pid = 'DATA1'
+        for i in range(0, len(data), max_packet):
+            self.data_in(addr, 0, data[i:i + max_packet], data_pid=data_pid)
+            data_pid = 'DATA0' if data_pid == 'DATA1' else 'DATA1'
+        self.data_out(addr, 0, b'', data_pid='DATA1')
+
+    def control_out(self, addr, bmRequestType, bRequest, wValue, wIndex):
+        self.setup(addr, bmRequestType, bRequest, wValue, wIndex, 0)
+        self.data_in(addr, 0, b'')
+
+    def next_frame(self):
+        self.time = (int(self.time / FRAME_TIME) + 1) * FRAME_TIME
+
+
+#--------------------------------------------------------------------------
+# Mouse enumeration, the capture shown in the README
+#--------------------------------------------------------------------------
+MOUSE_DEVICE_DESCRIPTOR = bytes([
+    0x12, 0x01, 0x10, 0x01, 0x00, 0x00, 0x00, 0x08, 0x8a, 0x25, 0x36, 0x00, 0x09, 0x01, 0x01, 0x02, 0x00, 0x01])
+MOUSE_CONFIG_DESCRIPTOR = bytes([
+    0x09, 0x02, 0x3b, 0x00, 0x02, 0x01, 0x00, 0xa0, 0xf0,
+    0x09, 0x04, 0x00, 0x00, 0x01, 0x03, 0x01, 0x02, 0x00,
+    0x09, 0x21, 0x11, 0x01, 0x00, 0x01, 0x22, 0x47, 0x00,
+    0x07, 0x05, 0x81, 0x03, 0x08, 0x00, 0x01,
+    0x09, 0x04, 0x01, 0x00, 0x01, 0x03, 0x01, 0x01, 0x00,
+    0x09, 0x21, 0x11, 0x01, 0x00, 0x01, 0x22, 0xd5, 0x00,
+    0x07, 0x05, 0x82, 0x03, 0x08, 0x00, 0x01])
+MOUSE_REPORT_DESCRIPTOR = bytes([
+    0x05, 0x01, 0x09, 0x02, 0xa1, 0x01, 0x09, 0x01, 0xa1, 0x00, 0x05, 0x09, 0x19, 0x01, 0x29, 0x05,
+    0x15, 0x00, 0x25, 0x01, 0x75, 0x01, 0x95, 0x05, 0x81, 0x02, 0x95, 0x03, 0x81, 0x01, 0x05, 0x01,
+    0x09, 0x30, 0x09, 0x31, 0x16, 0x00, 0x80, 0x26, 0xff, 0x7f, 0x75, 0x10, 0x95, 0x02, 0x81, 0x06,
+    0x09, 0x38, 0x15, 0x80, 0x25, 0x7f, 0x75, 0x08, 0x95, 0x01, 0x81, 0x06, 0x05, 0x0c, 0x0a, 0x38,
+    0x02, 0x95, 0x01, 0x81, 0x06, 0xc0, 0xc0])
+
+
+def string_descriptor(text):
+    encoded = text.encode('utf-16-le')
+    return bytes([len(encoded) + 2, 0x03]) + encoded
+
+
+def mouse_enumeration(builder=None, addr=1):
+    '''
+    Enumeration of a HID mouse at address 0, moved to addr, followed by a few
+    interrupt IN reports, like the README capture.
+    '''
+    b = builder or FrameBuilder()
+    b.control_in(0, 0x80, 0x06, 0x0100, 0, MOUSE_DEVICE_DESCRIPTOR[:8])
+    b.control_out(0, 0x00, 0x05, addr, 0)
+    b.next_frame()
+    b.control_in(addr, 0x80, 0x06, 0x0100, 0, MOUSE_DEVICE_DESCRIPTOR)
+    b.control_in(addr, 0x80, 0x06, 0x0300, 0, bytes([0x04, 0x03, 0x09, 0x04]))
+    b.control_in(addr, 0x80, 0x06, 0x0301, 0x0409, string_descriptor('SINOWEALTH'))
+    b.control_in(addr, 0x80, 0x06, 0x0302, 0x0409, string_descriptor('Wired Gaming Mouse'))
+    b.control_in(addr, 0x80, 0x06, 0x0200, 0, MOUSE_CONFIG_DESCRIPTOR[:9])
+    b.control_in(addr, 0x80, 0x06, 0x0200, 0, MOUSE_CONFIG_DESCRIPTOR)
+    b.control_out(addr, 0x00, 0x09, 1, 0)
+    b.control_in(addr, 0x81, 0x06, 0x2200, 0, MOUSE_REPORT_DESCRIPTOR)
+    b.control_out(addr, 0x21, 0x0A, 0, 0)
+    data_pid = 'DATA0'
+    for i in range(12):
+        b.next_frame()
+        report = bytes([0x00, 0x01 + (i & 1), 0x00, 0xff * (i & 1), 0xff * (i & 1), 0x00, 0x00])
+        b.data_in(addr, 1, report, data_pid=data_pid)
+        data_pid = 'DATA1' if data_pid == 'DATA0' else 'DATA0'
+    return b.frames
+
+
+#--------------------------------------------------------------------------
+# HID interrupt polling, mostly NAKs
+#--------------------------------------------------------------------------
+def hid_polling(builder=None, addr=1, endpoint=1, reports=200, naks_per_report=9):
+    '''
+    An interrupt IN endpoint polled every frame, where only one poll in
+    naks_per_report + 1 returns data.
+    '''
+    b = builder or FrameBuilder()
+    data_pid = 'DATA0'
+    for i in range(reports):
+        for _ in range(naks_per_report):
+            b.next_frame()
+            b.data_in(addr, endpoint, b'', handshake='NAK')
+        b.next_frame()
+        dx = (i * 7) & 0xff
+        b.data_in(addr, endpoint, bytes([i & 1, 0x00, dx, 0x00, 0x00, 0x00, 0x00]), data_pid=data_pid)
+        data_pid = 'DATA1' if data_pid == 'DATA0' else 'DATA0'
+    return b.frames
+
+
+#--------------------------------------------------------------------------
+# Bluetooth HCI ACL traffic (HCI Channel endpoint)
+#--------------------------------------------------------------------------
+def acl_packet(l2cap_channel, payload, handle=0x047, pb_flags=0x2):
+    '''
+    An HCI ACL packet holding one complete L2CAP frame.
+    '''
+    l2cap = len(payload).to_bytes(2, 'little') + l2cap_channel.to_bytes(2, 'little') + bytes(payload)
+    return (handle | (pb_flags << 12)).to_bytes(2, 'little') + len(l2cap).to_bytes(2, 'little') + l2cap
+
+
+def l2cap_signal(code, ident, params):
+    return bytes([code, ident]) + len(params).to_bytes(2, 'little') + bytes(params)
+
+
+def le16(*values):
+    return b''.join(v.to_bytes(2, 'little') for v in values)
+
+
+def sdp_attribute_list():
+    '''
+    A small SDP attribute list: ServiceRecordHandle, ServiceClassIDList (HID)
+    and ServiceName.
+    '''
+    name = b'Keyboard'
+    body = (bytes([0x09, 0x00, 0x00, 0x0a, 0x00, 0x01, 0x00, 0x01]) +
+            bytes([0x09, 0x00, 0x01, 0x35, 0x03, 0x19, 0x11, 0x24]) +
+            bytes([0x09, 0x01, 0x00, 0x25, len(name)]) + name)
+    return bytes([0x35, len(body)]) + body
+
+
+def sdp_search_attribute_responses(transaction_id, split=None):
+    '''
+    SDP_ServiceSearchAttributeResponse PDUs carrying the attribute list, in one
+    PDU or split at byte offset split over two, using a continuation state.
+    '''
+    attributes = bytes([0x35, 0]) + sdp_attribute_list()
+    attributes = bytes([0x35, len(attributes) - 2]) + attributes[2:]
+    parts = [attributes] if split is None else [attributes[:split], attributes[split:]]
+    pdus = []
+    for i, part in enumerate(parts):
+        continuation = bytes([0x02, 0x00, len(part)]) if i < len(parts) - 1 else bytes([0x00])
+        params = len(part).to_bytes(2, 'big') + part + continuation
+        pdus.append(bytes([0x07]) + (transaction_id + i).to_bytes(2, 'big') + len(params).to_bytes(2, 'big') + params)
+    return pdus
+
+
+BLUETOOTH_DEVICE_DESCRIPTOR = bytes([
+    0x12, 0x01, 0x00, 0x02, 0xe0, 0x01, 0x01, 0x40, 0x12, 0x0a, 0x01, 0x00, 0x91, 0x88, 0x00, 0x02, 0x00, 0x01])
+BLUETOOTH_CONFIG_DESCRIPTOR = bytes([
+    0x09, 0x02, 0x27, 0x00, 0x01, 0x01, 0x00, 0xe0, 0x32,
+    0x09, 0x04, 0x00, 0x00, 0x03, 0xe0, 0x01, 0x01, 0x00,
+    0x07, 0x05, 0x81, 0x03, 0x10, 0x00, 0x01,
+    0x07, 0x05, 0x82, 0x02, 0x40, 0x00, 0x00,
+    0x07, 0x05, 0x02, 0x02, 0x40, 0x00, 0x00])
+
+
+def bluetooth_enumeration(builder=None, addr=1):
+    '''
+    Enumeration of a Bluetooth dongle with its ACL data on bulk endpoint 2.
+    '''
+    b = builder or FrameBuilder()
+    b.control_in(0, 0x80, 0x06, 0x0100, 0, BLUETOOTH_DEVICE_DESCRIPTOR[:8], max_packet=64)
+    b.control_out(0, 0x00, 0x05, addr, 0)
+    b.next_frame()
+    b.control_in(addr, 0x80, 0x06, 0x0100, 0, BLUETOOTH_DEVICE_DESCRIPTOR, max_packet=64)
+    b.control_in(addr, 0x80, 0x06, 0x0200, 0, BLUETOOTH_CONFIG_DESCRIPTOR, max_packet=64)
+    b.control_out(addr, 0x00, 0x09, 1, 0)
+    return b.frames
+
+
+def bluetooth_hci(builder=None, addr=1, endpoint=2, repeats=1, hid_reports=50, enumerate=False):
+    '''
+    L2CAP signaling to open the SDP channel, an SDP search (one response split
+    over a continuation), disconnect, then HIDP interrupt channel reports.  With
+    enumerate the dongle is enumerated first, so the HCI channel can be found
+    from its descriptors.
+    '''
+    b = builder or FrameBuilder()
+    if enumerate:
+        bluetooth_enumeration(b, addr)
+    acl_out = lambda payload, channel: b.data_out(addr, endpoint, acl_packet(channel, payload))
+    acl_in = lambda payload, channel: b.data_in(addr, endpoint, acl_packet(channel, payload))
+    for r in range(repeats):
+        scid, dcid = 0x40 + (r & 0x7), 0x48 + (r & 0x7)
+        b.next_frame()
+        acl_out(l2cap_signal(0x02, 1, le16(0x0001, scid)), 1)
+        acl_in(l2cap_signal(0x03, 1, le16(dcid, scid, 0, 0)), 1)
+        acl_out(l2cap_signal(0x04, 2, le16(dcid, 0)), 1)
+        acl_in(l2cap_signal(0x05, 2, le16(scid, 0, 0)), 1)
+        acl_out(l2cap_signal(0x0A, 3, le16(2)), 1)
+        acl_in(l2cap_signal(0x0B, 3, le16(2, 0) + bytes([0x80, 0x02, 0x00, 0x00])), 1)
+        b.next_frame()
+        request = bytes([0x06, 0x00, 0x01, 0x00, 0x0f, 0x35, 0x03, 0x19, 0x11, 0x24, 0x03, 0xf0,
+                         0x35, 0x05, 0x0a, 0x00, 0x00, 0xff, 0xff, 0x00])
+        acl_out(request, dcid)
+        for pdu in sdp_search_attribute_responses(1, split=12):
+            acl_in(pdu, scid)
+        b.next_frame()
+        acl_out(l2cap_signal(0x06, 4, le16(dcid, scid)), 1)
+        acl_in(l2cap_signal(0x07, 4, le16(dcid, scid)), 1)
+    for i in range(hid_reports):
+        b.next_frame()
+        acl_in(bytes([0xA1, 0x01, 0x00, 0x00, 0x04 + (i % 26), 0, 0, 0, 0, 0]), 0x41)
+    return b.frames
+
+
+#--------------------------------------------------------------------------
+# High speed bulk streams
+#--------------------------------------------------------------------------
+MASS_STORAGE_DEVICE_DESCRIPTOR = bytes([
+    0x12, 0x01, 0x00, 0x02, 0x00, 0x00, 0x00, 0x40, 0x81, 0x07, 0x81, 0x55, 0x00, 0x01, 0x01, 0x02, 0x03, 0x01])
+MASS_STORAGE_CONFIG_DESCRIPTOR = bytes([
+    0x09, 0x02, 0x20, 0x00, 0x01, 0x01, 0x00, 0x80, 0x32,
+    0x09, 0x04, 0x00, 0x00, 0x02, 0x08, 0x06, 0x50, 0x00,
+    0x07, 0x05, 0x83, 0x02, 0x00, 0x02, 0x00,
+    0x07, 0x05, 0x03, 0x02, 0x00, 0x02, 0x00])
+
+
+def mass_storage_enumeration(builder=None, addr=1):
+    '''
+    Enumeration of a high speed mass storage device with 512 byte bulk endpoints 3 IN and OUT.
+    '''
+    b = builder or FrameBuilder()
+    b.control_in(0, 0x80, 0x06, 0x0100, 0, MASS_STORAGE_DEVICE_DESCRIPTOR[:8], max_packet=64)
+    b.control_out(0, 0x00, 0x05, addr, 0)
+    b.next_frame()
+    b.control_in(addr, 0x80, 0x06, 0x0100, 0, MASS_STORAGE_DEVICE_DESCRIPTOR, max_packet=64)
+    b.control_in(addr, 0x80, 0x06, 0x0200, 0, MASS_STORAGE_CONFIG_DESCRIPTOR, max_packet=64)
+    b.control_out(addr, 0x00, 0x09, 1, 0)
+    return b.frames
+
+
+def bulk_stream(builder=None, addr=1, endpoint=3, packets=200, packet_size=512, direction='OUT', enumerate=False):
+    '''
+    Back to back bulk packets of packet_size bytes, ending with a short packet.
+    With enumerate the mass storage enumeration comes first, so the HLA knows the
+    endpoint is a bulk one.
+    '''
+    b = builder or FrameBuilder()
+    if enumerate:
+        mass_storage_enumeration(b, addr)
+    data_pid = 'DATA0'
+    for i in range(packets):
+        size = packet_size if i < packets - 1 else packet_size // 3
+        payload = bytes((i + j) & 0xff for j in range(size))
+        if direction == 'OUT':
+            b.data_out(addr, endpoint, payload, data_pid=data_pid)
+        else:
+            b.data_in(addr, endpoint, payload, data_pid=data_pid)
+        data_pid = 'DATA1' if data_pid == 'DATA0' else 'DATA0'
+    return b.frames
+
+
+def payload_bytes(frames):
+    '''
+    Total bytes carried by the data frames in frames.
+    '''
+    return sum(len(frame.data['data']) for frame in frames if frame.type == 'data')